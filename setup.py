@@ -70,7 +70,9 @@ setup(
     python_requires='>=3.9',
     extras_require=dict(
         test=[
+            'transaction',
             'z3c.testing >= 1.0.0a3',
+            'ZODB',
             'zope.testing',
         ],
         configurator=[
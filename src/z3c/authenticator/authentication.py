@@ -13,12 +13,19 @@
 ##############################################################################
 """Authentication
 """
+import itertools
+import threading
+import time
+from concurrent import futures
+
+import BTrees.Length
 import zope.component
 import zope.event
 import zope.interface
 from zope.authentication.interfaces import IAuthentication
 from zope.authentication.interfaces import IUnauthenticatedPrincipal
 from zope.authentication.interfaces import PrincipalLookupError
+from zope.component import hooks
 from zope.component import queryNextUtility
 from zope.container import btree
 from zope.location.interfaces import ILocation
@@ -27,6 +34,69 @@ from zope.schema.interfaces import ISourceQueriables
 
 from z3c.authenticator import event
 from z3c.authenticator import interfaces
+from z3c.authenticator import stats
+from z3c.authenticator import throttle
+from z3c.authenticator import vocabulary
+from z3c.authenticator.stats import timedCall
+
+
+# thread pool shared by all authenticators using concurrentPrincipalLookup
+MAX_LOOKUP_WORKERS = 8
+_executor = None
+_executorLock = threading.Lock()
+
+
+def getLookupExecutor():
+    """Return the thread pool used for concurrent principal lookups."""
+    global _executor
+    if _executor is None:
+        with _executorLock:
+            if _executor is None:
+                _executor = futures.ThreadPoolExecutor(
+                    MAX_LOOKUP_WORKERS,
+                    thread_name_prefix='z3c.authenticator')
+    return _executor
+
+
+def shutdownLookupExecutor():
+    """Stop the concurrent principal lookup threads."""
+    global _executor
+    with _executorLock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown()
+
+
+# number of lookups per plugin still running after the caller gave up
+_overdue = {}
+_overdueLock = threading.Lock()
+
+
+def _lookupOverdue(plugin, future):
+    # a hung plugin would block a worker per lookup, so the plugin gets
+    # skipped until its overdue lookup is done
+    key = id(plugin)
+    with _overdueLock:
+        _overdue[key] = _overdue.get(key, 0) + 1
+
+    def done(future):
+        with _overdueLock:
+            count = _overdue.pop(key) - 1
+            if count:
+                _overdue[key] = count
+
+    future.add_done_callback(done)
+
+
+def _isOverdue(plugin):
+    return id(plugin) in _overdue
+
+
+def _queryPrincipalGlobally(plugin, id):
+    # the site of the caller is bound to its thread and ZODB connection, the
+    # workers use the global site manager
+    hooks.setSite(None)
+    return plugin.queryPrincipal(id)
 
 
 @zope.interface.implementer(IAuthentication,
@@ -40,6 +110,40 @@ class Authenticator(btree.BTreeContainer):
     includeNextUtilityForAuthenticate = FieldProperty(
         interfaces.IAuthenticator['includeNextUtilityForAuthenticate'])
 
+    concurrentPrincipalLookup = FieldProperty(
+        interfaces.IAuthenticator['concurrentPrincipalLookup'])
+
+    principalLookupTimeout = FieldProperty(
+        interfaces.IAuthenticator['principalLookupTimeout'])
+
+    collectStatistics = FieldProperty(
+        interfaces.IAuthenticator['collectStatistics'])
+
+    failedCredentialsTimeout = FieldProperty(
+        interfaces.IAuthenticator['failedCredentialsTimeout'])
+
+    maxFailedAttempts = FieldProperty(
+        interfaces.IAuthenticator['maxFailedAttempts'])
+
+    throttleAddresses = FieldProperty(
+        interfaces.IAuthenticator['throttleAddresses'])
+
+    trustedProxies = FieldProperty(
+        interfaces.IAuthenticator['trustedProxies'])
+
+    # principal created event factories, the event module provides compact
+    # ones using __slots__
+    authenticatedPrincipalCreated = event.AuthenticatedPrincipalCreated
+    foundPrincipalCreated = event.FoundPrincipalCreated
+    unauthenticatedPrincipalCreated = event.UnauthenticatedPrincipalCreated
+
+    # see vocabulary.pluginsVersion
+    _pluginsVersion = None
+
+    def __init__(self):
+        super().__init__()
+        self._pluginsVersion = BTrees.Length.Length()
+
     def _plugins(self, names, interface):
         for name in names:
             plugin = self.get(name)
@@ -57,18 +161,59 @@ class Authenticator(btree.BTreeContainer):
         return self._plugins(self.credentialsPlugins,
                              interfaces.ICredentialsPlugin)
 
+    def getStatistics(self):
+        return stats.getStatistics(self)
+
+    def _collector(self):
+        if self.collectStatistics:
+            return stats.getStatistics(self)
+        return None
+
     def authenticate(self, request):
-        authenticatorPlugins = [p for n, p in self.getAuthenticatorPlugins()]
+        collector = self._collector()
+        if collector is None:
+            return self._authenticate(request, None)
+        with collector.timer('authenticate'):
+            return self._authenticate(request, collector)
+
+    def _authenticate(self, request, collector):
+        failures = None
+        if self.failedCredentialsTimeout:
+            # reject repeated failures before any password gets checked
+            failures = throttle.getFailedAuthentications(self)
+            now = time.monotonic()
+            address = None
+            if self.throttleAddresses:
+                address = throttle.clientAddress(request, self.trustedProxies)
+            if failures.isBlocked(now, address=address):
+                if collector is not None:
+                    collector.increment('authenticate.rejected')
+                return None
+        failed = []
+        rejected = False
+
+        authenticatorPlugins = list(self.getAuthenticatorPlugins())
         for name, credplugin in self.getCredentialsPlugins():
-            credentials = credplugin.extractCredentials(request)
+            credentials = timedCall(collector, 'extractCredentials', name,
+                                    credplugin.extractCredentials, request)
             if credentials is None:
                 # do not invoke the auth plugin without credentials
                 continue
 
-            for authplugin in authenticatorPlugins:
+            login = None
+            if failures is not None:
+                login, digest = throttle.loginAndDigest(credentials)
+                if failures.isBlocked(now, digest, login):
+                    rejected = True
+                    continue
+                failed.append((digest, login))
+
+            for authname, authplugin in authenticatorPlugins:
                 if authplugin is None:
                     continue
-                principal = authplugin.authenticateCredentials(credentials)
+                principal = timedCall(
+                    collector, 'authenticateCredentials', authname,
+                    authplugin.authenticateCredentials, credentials)
                 if principal is None:
                     continue
 
@@ -76,37 +221,167 @@ class Authenticator(btree.BTreeContainer):
                 authenticated = interfaces.IAuthenticatedPrincipal(principal)
 
                 # send the IAuthenticatedPrincipalCreated event
-                zope.event.notify(event.AuthenticatedPrincipalCreated(
-                    self, authenticated, request))
+                factory = self.authenticatedPrincipalCreated
+                if event.hasSubscribers(factory):
+                    timedCall(collector, 'notify', None, zope.event.notify,
+                              factory(self, authenticated, request))
+                if collector is not None:
+                    collector.increment('authenticate.hits')
+                if login is not None:
+                    failures.succeeded(login)
                 return authenticated
 
-        if self.includeNextUtilityForAuthenticate:
+        if self.includeNextUtilityForAuthenticate and not rejected:
             next = queryNextUtility(self, IAuthentication)
             if next is not None:
-                principal = next.authenticate(request)
+                if collector is not None:
+                    collector.increment('authenticate.fallbacks')
+                principal = timedCall(collector, 'authenticate.fallback',
+                                      None, next.authenticate, request)
                 if principal is not None:
                     return principal
 
+        if failed:
+            timeout = self.failedCredentialsTimeout
+            for digest, login in failed:
+                failures.failed(now, timeout, self.maxFailedAttempts,
+                                digest, login)
+            failures.failed(now, timeout, self.maxFailedAttempts,
+                            address=address)
+        if collector is not None:
+            collector.increment(
+                'authenticate.rejected' if rejected else 'authenticate.misses')
         return None
 
-    def getPrincipal(self, id):
+    def _queryPrincipalConcurrently(self, id):
+        """Query the authenticator plugins concurrently.
+
+        Plugins stored in the ZODB are bound to the connection of the calling
+        thread. They get queried in this thread, in authenticatorPlugins
+        order, once all plugins before them missed. The other plugins run in
+        the thread pool using the global site manager. The result of the
+        first plugin in authenticatorPlugins order providing a principal
+        wins. Plugins still busy with a lookup which ran out of time get
+        skipped.
+        """
+        executor = getLookupExecutor()
+        timeout = self.principalLookupTimeout
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        pending = []
         for name, authplugin in self.getAuthenticatorPlugins():
-            principal = authplugin.queryPrincipal(id)
-            if principal is None:
-                continue
+            if getattr(authplugin, '_p_jar', None) is not None:
+                pending.append((authplugin, None))
+            elif not _isOverdue(authplugin):
+                pending.append((authplugin, executor.submit(
+                    _queryPrincipalGlobally, authplugin, id)))
+
+        try:
+            for authplugin, future in pending:
+                if future is None:
+                    result = authplugin.queryPrincipal(id)
+                else:
+                    if deadline is not None:
+                        timeout = max(deadline - time.monotonic(), 0)
+                    try:
+                        result = future.result(timeout)
+                    except futures.TimeoutError:
+                        if not future.cancel():
+                            _lookupOverdue(authplugin, future)
+                        continue
+                if result is not None:
+                    return result
+        finally:
+            for authplugin, future in pending:
+                if future is not None:
+                    future.cancel()
+        return None
 
-            # create found principal
-            found = interfaces.IFoundPrincipal(principal)
+    def _queryPrincipal(self, id, collector):
+        if self.concurrentPrincipalLookup:
+            return timedCall(collector, 'queryPrincipal.concurrent', None,
+                             self._queryPrincipalConcurrently, id)
+        for name, authplugin in self.getAuthenticatorPlugins():
+            principal = timedCall(collector, 'queryPrincipal', name,
+                                  authplugin.queryPrincipal, id)
+            if principal is not None:
+                return principal
+        return None
 
-            # send the IFoundPrincipalCreated event
-            zope.event.notify(event.FoundPrincipalCreated(self, found))
-            return found
+    def getPrincipal(self, id):
+        collector = self._collector()
+        if collector is None:
+            return self._getPrincipal(id, None)
+        with collector.timer('getPrincipal'):
+            return self._getPrincipal(id, collector)
+
+    def _found(self, principal, collector):
+        # create found principal
+        found = interfaces.IFoundPrincipal(principal)
+
+        # send the IFoundPrincipalCreated event
+        factory = self.foundPrincipalCreated
+        if event.hasSubscribers(factory):
+            timedCall(collector, 'notify', None, zope.event.notify,
+                      factory(self, found))
+        return found
+
+    def _getPrincipal(self, id, collector):
+        principal = self._queryPrincipal(id, collector)
+        if principal is not None:
+            if collector is not None:
+                collector.increment('getPrincipal.hits')
+            return self._found(principal, collector)
 
         next = queryNextUtility(self, IAuthentication)
         if next is not None:
-            return next.getPrincipal(id)
+            if collector is not None:
+                collector.increment('getPrincipal.fallbacks')
+            return timedCall(collector, 'getPrincipal.fallback', None,
+                             next.getPrincipal, id)
+        if collector is not None:
+            collector.increment('getPrincipal.misses')
         raise PrincipalLookupError(id)
 
+    def queryPrincipals(self, ids):
+        collector = self._collector()
+        if collector is None:
+            return self._queryPrincipals(ids, None)
+        with collector.timer('queryPrincipals'):
+            return self._queryPrincipals(ids, collector)
+
+    def _queryPrincipals(self, ids, collector):
+        missing = list(dict.fromkeys(ids))
+        principals = {}
+        for name, authplugin in self.getAuthenticatorPlugins():
+            if not missing:
+                break
+            if interfaces.IBulkAuthenticatorPlugin.providedBy(authplugin):
+                result = timedCall(collector, 'queryPrincipals', name,
+                                   authplugin.queryPrincipals, missing)
+            else:
+                result = {}
+                for id in missing:
+                    principal = timedCall(collector, 'queryPrincipal', name,
+                                          authplugin.queryPrincipal, id)
+                    if principal is not None:
+                        result[id] = principal
+            if result:
+                for id, principal in result.items():
+                    principals[id] = self._found(principal, collector)
+                missing = [id for id in missing if id not in result]
+
+        if missing:
+            next = queryNextUtility(self, IAuthentication)
+            if next is not None:
+                for id in missing:
+                    try:
+                        principals[id] = next.getPrincipal(id)
+                    except PrincipalLookupError:
+                        pass
+        return {id: principals[id] for id in ids if id in principals}
+
     def getQueriables(self):
         for name, authplugin in self.getAuthenticatorPlugins():
             queriable = zope.component.queryMultiAdapter(
@@ -114,6 +389,62 @@ class Authenticator(btree.BTreeContainer):
             if queriable is not None:
                 yield name, queriable
 
+    def _searchIterators(self, query, cursor):
+        iterators = []
+        for name, queriable in self.getQueriables():
+            if cursor is None:
+                offset = 0
+            elif name in cursor:
+                offset = cursor[name]
+            else:
+                # exhausted on a former page
+                continue
+            found = iter(queriable.search(query, start=offset))
+            iterators.append([name, found, offset])
+        return iterators
+
+    def search(self, query, start=None, batch_size=None):
+        iterators = self._searchIterators(query, None)
+        seen = set()
+
+        def merge():
+            # round-robin over the queriables, they get consumed lazily
+            while iterators:
+                for entry in list(iterators):
+                    try:
+                        id = next(entry[1])
+                    except StopIteration:
+                        iterators.remove(entry)
+                        continue
+                    if id not in seen:
+                        seen.add(id)
+                        yield id
+
+        stop = None if batch_size is None else (start or 0) + batch_size
+        yield from itertools.islice(merge(), start or 0, stop)
+
+    def searchPage(self, query, cursor=None, batch_size=20):
+        cursor = dict(cursor) if cursor is not None else None
+        iterators = self._searchIterators(query, cursor)
+        ids = []
+        seen = set()
+        while iterators and len(ids) < batch_size:
+            for entry in list(iterators):
+                if len(ids) >= batch_size:
+                    break
+                try:
+                    id = next(entry[1])
+                except StopIteration:
+                    iterators.remove(entry)
+                    continue
+                entry[2] += 1
+                if id not in seen:
+                    seen.add(id)
+                    ids.append(id)
+        if not iterators:
+            return ids, None
+        return ids, tuple((name, offset) for name, found, offset in iterators)
+
     def unauthenticatedPrincipal(self):
         """Return unauthenticated principal or None.
 
@@ -137,44 +468,156 @@ class Authenticator(btree.BTreeContainer):
         unauthenticated principal.
         """
         principal = zope.component.queryUtility(IUnauthenticatedPrincipal)
-        if principal is not None:
-            zope.event.notify(event.UnauthenticatedPrincipalCreated(self,
-                                                                    principal))
+        factory = self.unauthenticatedPrincipalCreated
+        if principal is not None and event.hasSubscribers(factory):
+            zope.event.notify(factory(self, principal))
         return principal
 
     def unauthorized(self, id, request):
-        challengeProtocol = None
+        collector = self._collector()
+        if collector is None:
+            return self._challenge('challenge', id, request, None)
+        with collector.timer('unauthorized'):
+            return self._challenge('challenge', id, request, collector)
 
+    def logout(self, request):
+        collector = self._collector()
+        if collector is None:
+            return self._challenge('logout', None, request, None)
+        with collector.timer('logout'):
+            return self._challenge('logout', None, request, collector)
+
+    def _challengePlan(self):
+        """Return the credentials plugins with their names and protocols.
+
+        The plan gets cached until the selected names or the version of the
+        plugins change, see vocabulary.pluginsVersion, so checking it neither
+        resolves nor loads the plugins. Nothing gets cached while the version
+        has uncommitted changes. It lives in a volatile attribute, so the
+        plugins are bound to the connection of this Authenticator.
+        """
+        version = vocabulary.pluginsVersion(self)
+        key = (tuple(self.credentialsPlugins), version)
+        cached = getattr(self, '_v_challengePlan', None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        steps = []
+        protocols = {}
         for name, credplugin in self.getCredentialsPlugins():
             protocol = getattr(credplugin, 'challengeProtocol', None)
-            if challengeProtocol is None or protocol == challengeProtocol:
-                if credplugin.challenge(request):
-                    if protocol is None:
-                        return
-                    elif challengeProtocol is None:
-                        challengeProtocol = protocol
-
-        if challengeProtocol is None:
+            steps.append((name, protocol, credplugin))
+            if protocol is not None:
+                protocols.setdefault(protocol, []).append(
+                    (name, credplugin))
+        plan = (tuple(steps),
+                {protocol: tuple(plugins)
+                 for protocol, plugins in protocols.items()})
+        if version is not None:
+            self._v_challengePlan = (key, plan)
+        return plan
+
+    def _runChallenge(self, steps, protocols, method, request, collector):
+        for name, protocol, credplugin in steps:
+            if not timedCall(collector, method, name,
+                             getattr(credplugin, method), request):
+                continue
+            if protocol is not None:
+                # only further plugins of the same protocol get called
+                plugins = protocols[protocol]
+                index = [other for other, plugin in plugins].index(name)
+                for other, plugin in plugins[index + 1:]:
+                    timedCall(collector, method, other,
+                              getattr(plugin, method), request)
+            return True
+        return False
+
+    def _challenge(self, method, id, request, collector):
+        """Challenge or logout with the credentials plugins.
+
+        The first plugin returning True defines the challenge protocol. Only
+        further plugins using the same protocol get called after that.
+        """
+        steps, protocols = self._challengePlan()
+
+        # look the selector factory up first, most sites don't register one
+        factory = zope.component.getSiteManager().adapters.lookup(
+            (zope.interface.providedBy(self),
+             zope.interface.providedBy(request)),
+            interfaces.IChallengeSelector)
+        selected = None
+        if factory is not None:
+            selector = factory(self, request)
+            if selector is not None:
+                selected = selector.select(method)
+        if selected:
+            byName = {step[0]: step for step in steps}
+            first = [byName[name] for name in selected if name in byName]
+            if self._runChallenge(first, protocols, method, request,
+                                  collector):
+                if collector is not None:
+                    collector.increment(method + '.selected')
+                return
+            steps = [step for step in steps if step[0] not in selected]
+
+        if not self._runChallenge(steps, protocols, method, request,
+                                  collector):
             next = queryNextUtility(self, IAuthentication)
             if next is not None:
-                next.unauthorized(id, request)
+                if collector is not None:
+                    collector.increment(method + '.fallbacks')
+                if method == 'challenge':
+                    next.unauthorized(id, request)
+                else:
+                    next.logout(request)
 
-    def logout(self, request):
-        challengeProtocol = None
 
-        for name, credplugin in self.getCredentialsPlugins():
-            protocol = getattr(credplugin, 'challengeProtocol', None)
-            if challengeProtocol is None or protocol == challengeProtocol:
-                if credplugin.logout(request):
-                    if protocol is None:
-                        return
-                    elif challengeProtocol is None:
-                        challengeProtocol = protocol
-
-        if challengeProtocol is None:
-            next = queryNextUtility(self, IAuthentication)
-            if next is not None:
-                next.logout(request)
+@zope.interface.implementer(interfaces.IChallengeSelector)
+class ChallengeSelector:
+    """Selects credentials plugins by path prefix and accepted content type.
+
+    Subclass it, set the routes and register it as adapter for the
+    Authenticator and the request:
+
+    >>> class APIChallengeSelector(ChallengeSelector):
+    ...     pathPrefixes = (('/api/', ('basic',)),)
+    ...     acceptTypes = (('application/json', ('basic',)),)
+
+    >>> from zope.publisher.browser import TestRequest
+    >>> request = TestRequest(environ={'PATH_INFO': '/api/users'})
+    >>> APIChallengeSelector(None, request).select('challenge')
+    ('basic',)
+
+    >>> request = TestRequest(
+    ...     environ={'HTTP_ACCEPT': 'application/json;q=0.9, */*;q=0.1'})
+    >>> APIChallengeSelector(None, request).select('challenge')
+    ('basic',)
+
+    >>> print(APIChallengeSelector(None, TestRequest()).select('challenge'))
+    None
+    """
+
+    # sequences of (path prefix, plugin names) and (type, plugin names)
+    pathPrefixes = ()
+    acceptTypes = ()
+
+    def __init__(self, authenticator, request):
+        self.authenticator = authenticator
+        self.request = request
+
+    def select(self, method):
+        environment = getattr(self.request, 'environment', {})
+        path = environment.get('PATH_INFO') or ''
+        for prefix, names in self.pathPrefixes:
+            if path.startswith(prefix):
+                return names
+        if self.acceptTypes:
+            accept = environment.get('HTTP_ACCEPT') or ''
+            accepted = {value.split(';')[0].strip().lower()
+                        for value in accept.split(',')}
+            for type, names in self.acceptTypes:
+                if type in accepted:
+                    return names
+        return None
 
 
 @zope.component.adapter(interfaces.ISearchable, interfaces.IAuthenticator)
@@ -200,3 +643,14 @@ class QueriableAuthenticator:
 
     def search(self, query, start=None, batch_size=None):
         yield from self.authplugin.search(query, start, batch_size)
+
+
+# Register our cleanup with Testing.CleanUp to make writing unit tests
+# simpler.
+try:
+    from zope.testing.cleanup import addCleanUp
+except ModuleNotFoundError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(shutdownLookupExecutor)
+    del addCleanUp
@@ -0,0 +1,500 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Benchmarks
+
+Runs the authentication and principal lookup benchmarks against an in-memory
+ZODB (DemoStorage) and writes the results as JSON::
+
+  python -m z3c.authenticator.benchmark --sizes 1000 100000 1000000 \\
+      --output bench.json
+
+Every result provides the benchmark name, the number of principals (size),
+the number of iterations and the min, mean, median and max time in seconds.
+Memory results provide the bytes and memory blocks retained per call and the
+peak bytes allocated within one call instead. Import results measure the
+import of the modules in a new interpreter; their size is the number of
+imported modules and they list the loaded browser packages. The concurrency
+result provides the ConflictError retries per commit of concurrent writers.
+Compare the JSON files of two releases to track regressions.
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import transaction
+import zope.component
+import zope.component.event  # noqa: F401 dispatch events to the handlers
+from ZODB.DB import DB
+from ZODB.DemoStorage import DemoStorage
+from ZODB.FileStorage import FileStorage
+from ZODB.POSException import ConflictError
+from zope.authentication.interfaces import IAuthentication
+from zope.publisher.browser import TestRequest
+
+from z3c.authenticator import authentication
+from z3c.authenticator import credential
+from z3c.authenticator import event
+from z3c.authenticator import group
+from z3c.authenticator import interfaces
+from z3c.authenticator import principal
+from z3c.authenticator import testing
+from z3c.authenticator import user
+
+
+# commit bulk loads in chunks to keep the memory usage low
+CHUNK_SIZE = 10000
+
+# modules needed to authenticate, without the widgets and browser views
+CORE_MODULES = (
+    'z3c.authenticator.authentication',
+    'z3c.authenticator.credential',
+    'z3c.authenticator.group',
+    'z3c.authenticator.principal',
+    'z3c.authenticator.principalregistry',
+    'z3c.authenticator.user',
+    'z3c.authenticator.vocabulary',
+)
+
+BROWSER_MODULES = (
+    'z3c.authenticator.widget',
+    'z3c.authenticator.browser.authenticator',
+    'z3c.authenticator.browser.group',
+    'z3c.authenticator.browser.user',
+)
+
+# packages only needed by the widgets and browser views
+BROWSER_PACKAGES = ('z3c.form', 'z3c.formui', 'z3c.template', 'z3c.contents')
+
+# imports the given modules in a new interpreter
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+for name in sys.argv[1:]:
+    __import__(name)
+seconds = time.perf_counter() - start
+loaded = [name for name in %r if name in sys.modules]
+print(json.dumps({'seconds': seconds, 'loaded': loaded}))
+""" % (BROWSER_PACKAGES,)
+
+
+def setUpComponents():
+    """Register the components used by the benchmarks."""
+    testing.setUpPasswordManager()
+    testing.sessionSetUp()
+    zope.component.provideAdapter(
+        principal.AuthenticatedPrincipal,
+        provides=interfaces.IAuthenticatedPrincipal)
+    zope.component.provideAdapter(
+        principal.FoundPrincipal, provides=interfaces.IFoundPrincipal)
+    zope.component.provideAdapter(
+        principal.FoundGroup, provides=interfaces.IFoundPrincipal)
+    zope.component.provideHandler(
+        group.setGroupsForPrincipal, [interfaces.IPrincipalCreated])
+
+
+def measure(name, size, func, iterations):
+    """Call func iterations times and return the timing result."""
+    times = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {
+        'name': name,
+        'size': size,
+        'iterations': iterations,
+        'min': min(times),
+        'mean': statistics.mean(times),
+        'median': statistics.median(times),
+        'max': max(times),
+    }
+
+
+def measureMemory(name, size, func, iterations):
+    """Call func iterations times and return the memory allocations."""
+    func()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        kept = [func() for i in range(iterations)]
+        after = tracemalloc.take_snapshot()
+        peak = 0
+        for i in range(iterations):
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            func()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+    finally:
+        tracemalloc.stop()
+    del kept
+    diff = after.compare_to(before, 'filename')
+    return {
+        'name': name,
+        'size': size,
+        'iterations': iterations,
+        'retained_bytes': sum(stat.size_diff for stat in diff) / iterations,
+        'retained_blocks': sum(stat.count_diff for stat in diff) / iterations,
+        'peak_bytes': peak,
+    }
+
+
+def measureImport(name, modules, iterations):
+    """Import the modules in iterations new interpreters.
+
+    Returns the timing result and the browser packages loaded by the import.
+    """
+    times = []
+    for i in range(iterations):
+        output = subprocess.check_output(
+            [sys.executable, '-c', IMPORT_SCRIPT] + list(modules))
+        data = json.loads(output)
+        times.append(data['seconds'])
+    return {
+        'name': name,
+        'size': len(modules),
+        'iterations': iterations,
+        'min': min(times),
+        'mean': statistics.mean(times),
+        'median': statistics.median(times),
+        'max': max(times),
+        'loaded': data['loaded'],
+    }
+
+
+def benchmarkImports(iterations):
+    """Measure the startup cost of importing the package."""
+    return [
+        measureImport('import (core)', CORE_MODULES, iterations),
+        measureImport('import (core, widget and browser)',
+                      CORE_MODULES + BROWSER_MODULES, iterations),
+    ]
+
+
+def login(i):
+    return 'user%d' % i
+
+
+def basicAuthRequest(login, password):
+    token = base64.b64encode(f'{login}:{password}'.encode()).decode()
+    return TestRequest(environ={'HTTP_AUTHORIZATION': 'Basic ' + token})
+
+
+def setUpAuthenticator(root):
+    auth = authentication.Authenticator()
+    root['auth'] = auth
+    auth['basic'] = credential.HTTPBasicAuthCredentialsPlugin()
+    auth['session'] = credential.SessionCredentialsPlugin()
+    auth['users'] = user.UserContainer()
+    auth['groups'] = group.GroupContainer('groups.')
+    auth.credentialsPlugins = ('basic', 'session')
+    auth.authenticatorPlugins = ('users', 'groups')
+    zope.component.provideUtility(auth, IAuthentication)
+    transaction.commit()
+    return auth
+
+
+def addUsers(users, size):
+    ids = []
+    for i in range(size):
+        uid, usr = users.add(
+            user.User(login(i), 'secret', 'User %d' % i,
+                      'Description of user %d' % i))
+        ids.append(uid)
+        if i % CHUNK_SIZE == CHUNK_SIZE - 1:
+            transaction.commit()
+    transaction.commit()
+    return ids
+
+
+def addGroups(groups, size):
+    for i in range(size):
+        groups.addGroup('g%d' % i, group.Group('Group %d' % i,
+                                               'Description of group %d' % i))
+        if i % CHUNK_SIZE == CHUNK_SIZE - 1:
+            transaction.commit()
+    transaction.commit()
+
+
+def benchmarkSize(size, iterations, depth):
+    """Run all benchmarks for the given number of principals."""
+    db = DB(DemoStorage())
+    conn = db.open()
+    try:
+        root = conn.root()
+        auth = setUpAuthenticator(root)
+        users = auth['users']
+        groups = auth['groups']
+        results = []
+
+        results.append(measure(
+            'generateUserIDToken', size,
+            lambda: [user.generateUserIDToken(login(i))
+                     for i in range(size)], 1))
+
+        ids = []
+        results.append(measure(
+            'UserContainer.add (bulk)', size,
+            lambda: ids.extend(addUsers(users, size)), 1))
+        results.append(measure(
+            'GroupContainer.addGroup (bulk)', size,
+            lambda: addGroups(groups, size), 1))
+
+        middle = size // 2
+        request = basicAuthRequest(login(middle), 'secret')
+        results.append(measure(
+            'Authenticator.authenticate (basic)', size,
+            lambda: auth.authenticate(request), iterations))
+
+        def authenticateSession():
+            auth.authenticate(TestRequest(
+                form={'login': login(middle), 'password': 'secret'}))
+        results.append(measure(
+            'Authenticator.authenticate (session)', size,
+            authenticateSession, iterations))
+
+        # a principal member of a chain of nested groups
+        chain = ['groups.g%d' % i for i in range(min(depth, size))]
+        if chain:
+            groups[chain[0]].principals = [ids[middle]]
+        for child, parent in zip(chain, chain[1:]):
+            groups[parent].principals = [child]
+        transaction.commit()
+
+        def getPrincipal():
+            found = auth.getPrincipal(ids[middle])
+            list(found.allGroups)
+        results.append(measure(
+            'Authenticator.getPrincipal (%d nested groups)' % len(chain),
+            size, getPrincipal, iterations))
+
+        results.append(measureMemory(
+            'Authenticator.getPrincipal (memory)', size,
+            lambda: auth.getPrincipal(ids[middle]), iterations))
+
+        # principal events get skipped without subscribers
+        gsm = zope.component.getGlobalSiteManager()
+        gsm.unregisterHandler(group.setGroupsForPrincipal,
+                              [interfaces.IPrincipalCreated])
+        try:
+            results.append(measureMemory(
+                'Authenticator.getPrincipal (memory, no subscribers)', size,
+                lambda: auth.getPrincipal(ids[middle]), iterations))
+        finally:
+            gsm.registerHandler(group.setGroupsForPrincipal,
+                                [interfaces.IPrincipalCreated])
+
+        # compact principals and events using __slots__
+        gsm.registerAdapter(principal.CompactFoundPrincipal,
+                            provided=interfaces.IFoundPrincipal)
+        auth.foundPrincipalCreated = event.CompactFoundPrincipalCreated
+        try:
+            results.append(measureMemory(
+                'Authenticator.getPrincipal (memory, compact)', size,
+                lambda: auth.getPrincipal(ids[middle]), iterations))
+        finally:
+            del auth.foundPrincipalCreated
+            gsm.registerAdapter(principal.FoundPrincipal,
+                                provided=interfaces.IFoundPrincipal)
+
+        search = {'search': login(middle)}
+        results.append(measure(
+            'UserContainer.search', size,
+            lambda: list(users.search(search, None, 20)), iterations))
+
+        search = {'search': 'Group %d' % middle}
+        results.append(measure(
+            'GroupContainer.search', size,
+            lambda: list(groups.search(search, None, 20)), iterations))
+
+        large = groups['groups.g%d' % (size - 1)]
+        # half of the members get replaced by other users
+        third = len(ids) // 3
+        members = [(ids[:2 * third], ids[:third] + ids[2 * third:])]
+
+        def setPrincipals():
+            # alternate between the two member lists
+            current, other = members[0]
+            large.setPrincipals(current)
+            members[0] = (other, current)
+        results.append(measure(
+            'Group.setPrincipals', size, setPrincipals, iterations))
+
+        snapshot = groups.exportSnapshot()
+        copy = group.GroupContainer('groups.')
+        results.append(measure(
+            'GroupContainer.importSnapshot', size,
+            lambda: copy.importSnapshot(snapshot), iterations))
+        return results
+    finally:
+        transaction.abort()
+        conn.close()
+        db.close()
+
+
+def benchmarkConflicts(workers, operations, size=1000, principals=20,
+                       attempts=10, factory=user.UserContainer):
+    """Run concurrent user signups and group member changes.
+
+    Every worker thread adds users to a container of size users and toggles
+    principals of a small shared pool in its own group, so the workers change
+    the groups of the same principals. Every other group change adds a new
+    principal which all workers add to their groups at about the same time.
+    Returns the number of ConflictError retries per commit.
+    """
+    tmpdir = tempfile.mkdtemp()
+    db = DB(FileStorage(os.path.join(tmpdir, 'Data.fs')),
+            pool_size=max(7, workers))
+    try:
+        conn = db.open()
+        root = conn.root()
+        root['users'] = users = factory()
+        root['groups'] = groups = group.GroupContainer('groups.')
+        addUsers(users, size)
+        for worker in range(workers):
+            groups.addGroup('w%d' % worker, group.Group('Worker %d' % worker))
+        transaction.commit()
+        conn.close()
+
+        pool = ['p%d' % i for i in range(principals)]
+        counts = {'commits': 0, 'conflicts': 0, 'failures': 0}
+        lock = threading.Lock()
+
+        def work(worker):
+            rand = random.Random(worker)
+            tm = transaction.TransactionManager()
+            conn = db.open(tm)
+            try:
+                root = conn.root()
+                for i in range(operations):
+                    for attempt in range(attempts):
+                        try:
+                            tm.begin()
+                            if i % 2:
+                                root['users'].add(user.User(
+                                    'w%d-%d' % (worker, i), 'secret',
+                                    'User %d' % i))
+                            else:
+                                member = root['groups']['groups.w%d' % worker]
+                                pids = set(member.principals)
+                                if i % 4:
+                                    pids.symmetric_difference_update(
+                                        [rand.choice(pool)])
+                                else:
+                                    pids.add('n%d' % i)
+                                member.setPrincipals(sorted(pids), False)
+                            tm.commit()
+                        except ConflictError:
+                            tm.abort()
+                            with lock:
+                                counts['conflicts'] += 1
+                        else:
+                            with lock:
+                                counts['commits'] += 1
+                            break
+                    else:
+                        with lock:
+                            counts['failures'] += 1
+            finally:
+                conn.close()
+
+        threads = [threading.Thread(target=work, args=(worker,))
+                   for worker in range(workers)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - start
+    finally:
+        db.close()
+        shutil.rmtree(tmpdir)
+    return {
+        'name': 'Concurrent signups and group changes (%s)' % (
+            factory.__name__),
+        'size': size,
+        'workers': workers,
+        'iterations': operations,
+        'seconds': seconds,
+        'commits': counts['commits'],
+        'conflicts': counts['conflicts'],
+        'failures': counts['failures'],
+        'retry_rate': counts['conflicts'] / max(counts['commits'], 1),
+    }
+
+
+def run(sizes=(1000,), iterations=10, depth=10, imports=True,
+        conflicts=False):
+    """Run the benchmarks and return the machine-readable report.
+
+    The conflict benchmark writes temporary FileStorage databases and only
+    runs if conflicts is true.
+    """
+    setUpComponents()
+    results = []
+    if imports:
+        results.extend(benchmarkImports(iterations))
+    if conflicts:
+        for factory in (user.UserContainer, user.ShardedUserContainer):
+            results.append(benchmarkConflicts(
+                4, 10 * iterations, max(sizes), factory=factory))
+    for size in sizes:
+        results.extend(benchmarkSize(size, iterations, depth))
+    return {
+        'python': sys.version.split()[0],
+        'implementation': platform.python_implementation(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'results': results,
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='z3c.authenticator benchmarks')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000],
+                        help='number of principals (default: 1000)')
+    parser.add_argument('--iterations', type=int, default=10,
+                        help='iterations per benchmark (default: 10)')
+    parser.add_argument('--depth', type=int, default=10,
+                        help='depth of the nested groups (default: 10)')
+    parser.add_argument('--no-imports', dest='imports', action='store_false',
+                        help='skip the import benchmarks')
+    parser.add_argument('--conflicts', action='store_true',
+                        help='run the conflict benchmark on temporary'
+                             ' FileStorage databases')
+    parser.add_argument('--output', default='-',
+                        help='JSON output file (default: stdout)')
+    options = parser.parse_args(args)
+    report = run(options.sizes, options.iterations, options.depth,
+                 options.imports, options.conflicts)
+    if options.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
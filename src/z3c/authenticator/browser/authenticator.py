@@ -13,16 +13,26 @@
 ##############################################################################
 """Authenticator Forms
 """
+import collections
+import itertools
+import json
+import threading
+import time
+
 import zope.event
 import zope.interface
 import zope.lifecycleevent
 import zope.schema
+from z3c.form import button
 from z3c.form import field
 from z3c.formui import form
+from z3c.template.template import getPageTemplate
+from zope.publisher.browser import BrowserView
 from zope.traversing.browser import absoluteURL
 
 from z3c.authenticator import interfaces
 from z3c.authenticator.authentication import Authenticator
+from z3c.authenticator.volatile import VolatileRegistry
 
 
 # Make z3c.configurator optional.
@@ -75,4 +85,183 @@ class AuthenticatorEditForm(form.EditForm):
 
     fields = field.Fields(interfaces.IAuthenticator).select(
         'includeNextUtilityForAuthenticate', 'credentialsPlugins',
-        'authenticatorPlugins')
+        'authenticatorPlugins', 'concurrentPrincipalLookup',
+        'principalLookupTimeout', 'collectStatistics',
+        'failedCredentialsTimeout', 'maxFailedAttempts', 'throttleAddresses',
+        'trustedProxies')
+
+
+class AuthenticatorStatisticsForm(form.Form):
+    """Shows the statistics collected by the Authenticator."""
+
+    template = getPageTemplate()
+
+    label = _('Authenticator Statistics')
+
+    def _rows(self, timings, plugin=None):
+        return [{'operation': operation, 'plugin': plugin,
+                 'count': data['count'],
+                 'total': '%.3f' % (data['total'] * 1000),
+                 'average': '%.3f' % (data['total'] * 1000 / data['count']),
+                 'max': '%.3f' % (data['max'] * 1000)}
+                for operation, data in timings.items()]
+
+    def update(self):
+        super().update()
+        report = self.context.getStatistics().report()
+        self.timings = self._rows(report['timings'])
+        self.plugins = []
+        for operation, plugins in report['plugins'].items():
+            for name, data in plugins.items():
+                self.plugins.extend(
+                    self._rows({operation: data}, plugin=name))
+        self.counters = sorted(report['counters'].items())
+
+    @button.buttonAndHandler(_('Reset'), name='reset')
+    def handleReset(self, action):
+        self.context.getStatistics().reset()
+        self.status = _('Statistics reset.')
+
+
+# search results by (query, start, limit) per authenticator, see
+# PrincipalSearch
+_searchCaches = VolatileRegistry(collections.OrderedDict)
+# search request times by principal id, the least recently active first,
+# see PrincipalSearch
+_searchRequests = collections.OrderedDict()
+_searchLock = threading.Lock()
+
+
+class PrincipalSearch(BrowserView):
+    """Type-ahead principal search returning JSON.
+
+    The search string gets passed as ``q``. The result contains at most
+    ``limit`` principals starting at the ``start`` offset over the
+    queriables of the authenticator. Only as many ids as needed get pulled
+    from the search generators of the queriables. If ``more`` is true the
+    next batch can get fetched with ``start`` set to ``next``.
+    """
+
+    # the maximum and default number of principals per response
+    maxLimit = 50
+    defaultLimit = 10
+    # the search string needs at least that many characters
+    minLength = 2
+    # seconds a result gets reused for the same query, and the number of
+    # cached results per authenticator
+    cacheTimeout = 10.0
+    cacheSize = 1000
+    # allowed requests per principal within rateWindow seconds, and the
+    # number of principals whose requests are remembered
+    rateLimit = 20
+    rateWindow = 5.0
+    rateLimitedPrincipals = 10000
+
+    def _int(self, name, default):
+        try:
+            return max(int(self.request.form.get(name, default)), 0)
+        except (TypeError, ValueError):
+            return default
+
+    def _json(self, data, status=200):
+        response = self.request.response
+        if status == 429:
+            response.setStatus(status, 'Too Many Requests')
+        else:
+            response.setStatus(status)
+        response.setHeader('Content-Type', 'application/json')
+        response.setHeader('Cache-Control', 'no-store')
+        return json.dumps(data)
+
+    def _retryAfter(self, now):
+        """Record the request and return the seconds to wait if limited."""
+        principal = getattr(self.request, 'principal', None)
+        key = principal.id if principal is not None else None
+        with _searchLock:
+            # forget the principals idle for longer than the window
+            while _searchRequests:
+                times = next(iter(_searchRequests.values()))
+                if times and times[-1] > now - self.rateWindow:
+                    break
+                _searchRequests.popitem(last=False)
+            times = _searchRequests.get(key)
+            if times is None:
+                times = _searchRequests[key] = collections.deque()
+                while len(_searchRequests) > self.rateLimitedPrincipals:
+                    _searchRequests.popitem(last=False)
+            else:
+                _searchRequests.move_to_end(key)
+            while times and times[0] <= now - self.rateWindow:
+                times.popleft()
+            if len(times) >= self.rateLimit:
+                return times[0] + self.rateWindow - now
+            times.append(now)
+        return None
+
+    def _search(self, query, start, limit):
+        ids = []
+        names = {}
+        # fetch one more id to know if there are more results
+        needed = start + limit + 1
+        for name, queriable in self.context.getQueriables():
+            found = queriable.search({'search': query},
+                                     batch_size=needed - len(ids))
+            for id in itertools.islice(found, needed - len(ids)):
+                if id not in names:
+                    names[id] = name
+                    ids.append(id)
+            if len(ids) >= needed:
+                break
+        batch = ids[start:start + limit]
+        principals = self.context.queryPrincipals(batch)
+        results = [{'id': id, 'title': principals[id].title,
+                    'queriable': names[id]}
+                   for id in batch if id in principals]
+        more = len(ids) > start + limit
+        return {'results': results, 'more': more,
+                'next': start + limit if more else None}
+
+    def __call__(self):
+        query = (self.request.form.get('q') or '').strip()
+        start = self._int('start', 0)
+        limit = min(self._int('limit', self.defaultLimit), self.maxLimit)
+        if len(query) < self.minLength or not limit:
+            return self._json({'results': [], 'more': False, 'next': None})
+
+        now = time.monotonic()
+        retryAfter = self._retryAfter(now)
+        if retryAfter is not None:
+            self.request.response.setHeader(
+                'Retry-After', str(max(int(retryAfter + 0.999), 1)))
+            return self._json({'error': 'Too many requests'}, 429)
+
+        cache = _searchCaches.get(self.context)
+        key = (query.lower(), start, limit)
+        with _searchLock:
+            cached = cache.get(key)
+        if cached is not None and cached[0] > now:
+            return self._json(cached[1])
+
+        data = self._search(query, start, limit)
+        with _searchLock:
+            cache[key] = (now + self.cacheTimeout, data)
+            cache.move_to_end(key)
+            while len(cache) > self.cacheSize:
+                cache.popitem(last=False)
+        return self._json(data)
+
+
+def _clear():
+    with _searchLock:
+        _searchRequests.clear()
+
+
+# Register our cleanup with Testing.CleanUp to make writing unit tests
+# simpler.
+try:
+    from zope.testing.cleanup import addCleanUp
+except ModuleNotFoundError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(_clear)
+    del addCleanUp
@@ -13,11 +13,47 @@
 ##############################################################################
 """Events
 """
+import zope.component
+import zope.component.event
+import zope.event
 import zope.interface
 
 from z3c.authenticator import interfaces
 
 
+def hasSubscribers(factory):
+    """Return True if an event created by factory could reach a subscriber.
+
+    This allows us to skip creating principal events nobody listens to:
+
+    >>> hasSubscribers(FoundPrincipalCreated)
+    False
+
+    >>> handled = []
+    >>> zope.component.provideHandler(handled.append,
+    ...     [interfaces.IPrincipalCreated])
+    >>> hasSubscribers(FoundPrincipalCreated)
+    True
+
+    >>> zope.component.getGlobalSiteManager().unregisterHandler(
+    ...     handled.append, [interfaces.IPrincipalCreated])
+    True
+
+    Any non component based zope.event subscriber could handle the event:
+
+    >>> zope.event.subscribers.append(handled.append)
+    >>> hasSubscribers(FoundPrincipalCreated)
+    True
+
+    >>> zope.event.subscribers.remove(handled.append)
+    """
+    for subscriber in zope.event.subscribers:
+        if subscriber is not zope.component.event.dispatch:
+            return True
+    return bool(zope.component.getSiteManager().adapters.subscriptions(
+        (zope.interface.implementedBy(factory),), None))
+
+
 # principal events
 @zope.interface.implementer(interfaces.IAuthenticatedPrincipalCreated)
 class AuthenticatedPrincipalCreated:
@@ -63,6 +99,65 @@ class FoundPrincipalCreated:
         self.principal = principal
 
 
+class CompactPrincipalCreatedBase:
+    """Base class for principal created events using ``__slots__``.
+
+    The events have no instance dictionary, subscribers can't set
+    additional attributes. Use them as event factories of the Authenticator
+    if you don't need that.
+    """
+
+    __slots__ = ('authentication', 'principal', '__provides__')
+
+    def __init__(self, authentication, principal):
+        self.authentication = authentication
+        self.principal = principal
+
+
+@zope.interface.implementer(interfaces.IAuthenticatedPrincipalCreated)
+class CompactAuthenticatedPrincipalCreated(CompactPrincipalCreatedBase):
+    """
+    >>> from zope.interface.verify import verifyObject
+    >>> event = CompactAuthenticatedPrincipalCreated('authentication',
+    ...     'principal', 'request')
+    >>> verifyObject(interfaces.IAuthenticatedPrincipalCreated, event)
+    True
+    >>> event.other = 'other'  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    AttributeError: '...' object has no attribute 'other'
+    """
+
+    __slots__ = ('request',)
+
+    __init__ = AuthenticatedPrincipalCreated.__init__
+
+
+@zope.interface.implementer(interfaces.IUnauthenticatedPrincipalCreated)
+class CompactUnauthenticatedPrincipalCreated(CompactPrincipalCreatedBase):
+    """
+    >>> from zope.interface.verify import verifyObject
+    >>> event = CompactUnauthenticatedPrincipalCreated('authentication',
+    ...     'principal')
+    >>> verifyObject(interfaces.IUnauthenticatedPrincipalCreated, event)
+    True
+    """
+
+    __slots__ = ()
+
+
+@zope.interface.implementer(interfaces.IFoundPrincipalCreated)
+class CompactFoundPrincipalCreated(CompactPrincipalCreatedBase):
+    """
+    >>> from zope.interface.verify import verifyObject
+    >>> event = CompactFoundPrincipalCreated('authentication', 'principal')
+    >>> verifyObject(interfaces.IFoundPrincipalCreated, event)
+    True
+    """
+
+    __slots__ = ()
+
+
 # group events
 @zope.interface.implementer(interfaces.IGroupAdded)
 class GroupAdded:
@@ -13,8 +13,15 @@
 ##############################################################################
 """Group Folders
 """
+import itertools
+import json
+import zlib
+
+import BTrees.Interfaces
+import BTrees.Length
 import BTrees.OOBTree
 import persistent
+import transaction
 import zope.component
 import zope.event
 import zope.interface
@@ -30,6 +37,14 @@ from zope.security.interfaces import IGroupAwarePrincipal
 
 from z3c.authenticator import event
 from z3c.authenticator import interfaces
+from z3c.authenticator.index import rankResults
+from z3c.authenticator.index import relevance
+from z3c.authenticator.principal import invalidateGroupClosures
+
+
+# header and format version of GroupContainer snapshots
+SNAPSHOT_MAGIC = b'z3c.authenticator.groups\n'
+SNAPSHOT_VERSION = 1
 
 
 @zope.interface.implementer(interfaces.IGroup)
@@ -90,14 +105,139 @@ class Group(persistent.Persistent, contained.Contained):
         return f"<{self.__class__.__name__} {self.__name__}>"
 
 
+def mergeGroups(old, saved, new):
+    """Merge two concurrent changes of the groups of a principal.
+
+    >>> mergeGroups(('g1', 'g2'), ('g1', 'g2', 'g3'), ('g2', 'g4'))
+    ('g2', 'g3', 'g4')
+    >>> mergeGroups((), ('g1',), ('g2',))
+    ('g1', 'g2')
+    >>> mergeGroups(('g1',), (), ())
+    ()
+    """
+    if saved == new or old == new:
+        return saved
+    if old == saved:
+        return new
+    removed = set(old) - set(new)
+    groups = [gid for gid in saved if gid not in removed]
+    groups.extend([gid for gid in new if gid not in old and gid not in saved])
+    return tuple(groups)
+
+
+def _next(state):
+    # the oid of the next bucket, references of different objects don't
+    # compare during conflict resolution
+    return [getattr(ref, 'oid', ref) for ref in state[1:]]
+
+
+def _mergeBucketState(oldState, savedState, newState):
+    # a bucket state is a tuple of the flattened items and the next bucket
+    if oldState is None:
+        oldState = ((),)
+    if not (_next(oldState) == _next(savedState) == _next(newState)):
+        raise BTrees.Interfaces.BTreesConflictError(-1, -1, -1, 0)
+    old, saved, new = (
+        dict(zip(state[0][::2], state[0][1::2]))
+        for state in (oldState, savedState, newState))
+    items = []
+    for pid in sorted(set(saved).union(new)):
+        groups = mergeGroups(
+            old.get(pid, ()), saved.get(pid, ()), new.get(pid, ()))
+        if groups:
+            items.extend((pid, groups))
+    if not items:
+        # the bucket can't be unlinked from its parent here
+        raise BTrees.Interfaces.BTreesConflictError(-1, -1, -1, 12)
+    return (tuple(items),) + savedState[1:]
+
+
+def _isInline(state):
+    return (state is not None and len(state) == 1 and len(state[0]) == 1 and
+            isinstance(state[0][0], tuple))
+
+
+class GroupMappingBucket(BTrees.OOBTree.OOBucket):
+    """Bucket merging concurrent changes of the groups of a principal.
+
+    >>> old = (('p1', ('g1',), 'p2', ('g1',)),)
+    >>> committed = (('p1', ('g1', 'g2'), 'p2', ('g1',)),)
+    >>> new = (('p1', ('g1', 'g3'), 'p3', ('g3',)),)
+    >>> GroupMappingBucket()._p_resolveConflict(old, committed, new)
+    (('p1', ('g1', 'g2', 'g3'), 'p3', ('g3',)),)
+    """
+
+    def _p_resolveConflict(self, oldState, savedState, newState):
+        return _mergeBucketState(oldState, savedState, newState)
+
+
+class GroupMapping(BTrees.OOBTree.OOBTree):
+    """Maps principal ids to the tuple of their group ids.
+
+    Concurrent changes of the groups of the same principal get merged, also
+    if the first group of a new principal gets added twice:
+
+    >>> committed = (((('p1', ('g1',)),),),)
+    >>> new = (((('p1', ('g2',)),),),)
+    >>> GroupMapping()._p_resolveConflict(None, committed, new)
+    (((('p1', ('g1', 'g2')),),),)
+    """
+
+    _bucket_type = GroupMappingBucket
+
+    def _p_resolveConflict(self, oldState, savedState, newState):
+        # a BTree with a single bucket stores the bucket state inline,
+        # changes of more than one bucket can't be merged
+        if (oldState is None or _isInline(oldState)) and \
+                _isInline(savedState) and _isInline(newState):
+            return ((_mergeBucketState(
+                oldState and oldState[0][0], savedState[0][0],
+                newState[0][0]),),)
+        return super()._p_resolveConflict(oldState, savedState, newState)
+
+
+def _snapshotColumns(data):
+    """Return the member table and the group columns of a snapshot.
+
+    Raises ValueError if they are missing, the columns differ in length or a
+    member refers to a position outside of the table.
+    """
+    table = data.get('principals')
+    columns = data.get('groups')
+    if not isinstance(table, list) or not isinstance(columns, dict):
+        raise ValueError('Invalid group snapshot: missing principals or '
+                         'groups')
+    names = ('ids', 'titles', 'descriptions', 'members')
+    for name in names:
+        if not isinstance(columns.get(name), list):
+            raise ValueError('Invalid group snapshot: missing %s' % name)
+    if len({len(columns[name]) for name in names}) != 1:
+        raise ValueError('Invalid group snapshot: columns differ in length')
+    size = len(table)
+    for members in columns['members']:
+        if not isinstance(members, list) or not all(
+                type(i) is int and 0 <= i < size for i in members):
+            raise ValueError('Invalid group snapshot: unknown member')
+    return table, columns
+
+
 @zope.interface.implementer(interfaces.IGroupContainer)
 class GroupContainer(btree.BTreeContainer):
 
+    # (principal id, group id) pairs changed in this process since the last
+    # verification, None if unknown
+    _v_touched = None
+
+    # the incremental verification falls back to a full one if more
+    # memberships changed
+    maxTouched = 10000
+
     def __init__(self, prefix=''):
         self.prefix = prefix
         super().__init__()
         # __inversemapping is used to map principals to groups
-        self.__inverseMapping = BTrees.OOBTree.OOBTree()
+        self.__inverseMapping = GroupMapping()
+        self._v_touched = set()
 
     def __setitem__(self, name, group):
         """Add a IGroup object within a correct id.
@@ -155,21 +295,31 @@ class GroupContainer(btree.BTreeContainer):
                 event.PrincipalsRemovedFromGroup(group.principals, gid))
         super().__delitem__(gid)
 
+    def _touch(self, pids, gid):
+        touched = self._v_touched
+        if touched is None or not pids:
+            return
+        touched.update([(pid, gid) for pid in pids])
+        if len(touched) > self.maxTouched:
+            self._v_touched = None
+
+    def _setGroups(self, pid, groups):
+        if groups:
+            self.__inverseMapping[pid] = tuple(groups)
+        else:
+            self.__inverseMapping.pop(pid, None)
+
     def _addPrincipalsToGroup(self, pids, gid):
+        self._touch(pids, gid)
         for pid in pids:
-            self.__inverseMapping[pid] = (
-                self.__inverseMapping.get(pid, ()) + (gid,))
+            self._setGroups(pid, self.getGroupsForPrincipal(pid) + (gid,))
 
     def _removePrincipalsFromGroup(self, pids, gid):
+        self._touch(pids, gid)
         for pid in pids:
-            groups = self.__inverseMapping.get(pid)
-            if groups is None:
-                return
-            new = tuple([id for id in groups if id != gid])
-            if new:
-                self.__inverseMapping[pid] = new
-            else:
-                del self.__inverseMapping[pid]
+            groups = self.getGroupsForPrincipal(pid)
+            if gid in groups:
+                self._setGroups(pid, [id for id in groups if id != gid])
 
     def getGroupsForPrincipal(self, pid):
         """Get groups the given principal belongs to"""
@@ -179,20 +329,235 @@ class GroupContainer(btree.BTreeContainer):
         """Get principals which belong to the group"""
         return self[gid].principals
 
+    def exportSnapshot(self):
+        """Export the groups and their members as a compact snapshot.
+
+        The snapshot is zlib compressed JSON, stored by column. Every member
+        id is stored once in a table and the member lists refer to the
+        position of the member in that table.
+        """
+        names = []
+        titles = []
+        descriptions = []
+        members = []
+        table = {}
+        for gid, group in self.items():
+            names.append(gid)
+            titles.append(group.title)
+            descriptions.append(group.description)
+            members.append([table.setdefault(pid, len(table))
+                            for pid in group.principals])
+        data = {
+            'version': SNAPSHOT_VERSION,
+            'prefix': self.prefix,
+            'principals': list(table),
+            'groups': {
+                'ids': names,
+                'titles': titles,
+                'descriptions': descriptions,
+                'members': members,
+            },
+        }
+        payload = json.dumps(data, separators=(',', ':')).encode('utf-8')
+        return SNAPSHOT_MAGIC + zlib.compress(payload)
+
+    def importSnapshot(self, data):
+        """Replace all groups with the groups of the given snapshot.
+
+        The BTrees get loaded at once and the inverse mapping gets rebuilt
+        at the end. No cycle checks are done. After loading, the events of
+        the changed memberships and the added groups get sent and the groups
+        of groups remembered for the interaction get forgotten.
+        """
+        if not data.startswith(SNAPSHOT_MAGIC):
+            raise ValueError('Not a group snapshot')
+        try:
+            payload = zlib.decompress(data[len(SNAPSHOT_MAGIC):])
+            data = json.loads(payload.decode('utf-8'))
+        except (zlib.error, ValueError) as e:
+            raise ValueError('Invalid group snapshot: %s' % e)
+        if not isinstance(data, dict):
+            raise ValueError('Invalid group snapshot: no mapping')
+        if data.get('version') != SNAPSHOT_VERSION:
+            raise ValueError(
+                'Unsupported group snapshot version: %s' % data.get('version'))
+        if data.get('prefix') != self.prefix:
+            raise ValueError('Wrong prefix used in group snapshot!')
+
+        table, columns = _snapshotColumns(data)
+        for gid in columns['ids']:
+            if not isinstance(gid, str) or not gid.startswith(self.prefix):
+                raise ValueError('Wrong prefix used in group id %r!' % gid)
+        items = {}
+        inverse = {}
+        for gid, title, description, members in zip(
+                columns['ids'], columns['titles'], columns['descriptions'],
+                columns['members']):
+            group = Group(title, description)
+            group._principals = tuple([table[i] for i in members])
+            group.__parent__ = self
+            group.__name__ = gid
+            items[gid] = group
+            for pid in group._principals:
+                inverse.setdefault(pid, []).append(gid)
+
+        old = {gid: group.principals
+               for gid, group in self._SampleContainer__data.items()}
+        self._SampleContainer__data = BTrees.OOBTree.OOBTree(items)
+        self._BTreeContainer__len = BTrees.Length.Length(len(items))
+        self.__inverseMapping = GroupMapping(
+            {pid: tuple(gids) for pid, gids in inverse.items()})
+        self._v_touched = set()
+        invalidateGroupClosures(None)
+        self._notifyImported(old, items)
+        return len(items)
+
+    def _notifyImported(self, old, items):
+        for gid, principals in old.items():
+            group = items.get(gid)
+            new = set(group.principals) if group is not None else ()
+            removed = [pid for pid in principals if pid not in new]
+            if removed:
+                zope.event.notify(
+                    event.PrincipalsRemovedFromGroup(removed, gid))
+        for gid, group in items.items():
+            principals = set(old.get(gid, ()))
+            added = [pid for pid in group.principals if pid not in principals]
+            if added:
+                zope.event.notify(event.PrincipalsAddedToGroup(added, gid))
+            if gid not in old:
+                zope.event.notify(event.GroupAdded(group))
+
+    def verifyInverseMapping(self, repair=False, incremental=False,
+                             chunkSize=1000):
+        """Verify and optionally repair the principal to group mapping.
+
+        The full verification releases the loaded groups from the cache of
+        the connection after every chunkSize groups. The repair creates a
+        savepoint after every chunkSize changed principals. It also moves the
+        plain OOBTree mapping of containers created before GroupMapping into
+        a GroupMapping, with a savepoint after every chunkSize principals.
+        The incremental verification only checks the memberships changed
+        through this container object since its last verification. The
+        changes are tracked in a volatile attribute, so the incremental
+        verification does a full one if they got lost because the container
+        got unloaded, or if there were more than maxTouched changes.
+        """
+        if incremental and self._v_touched is not None:
+            report = self._verifyTouched(repair, chunkSize)
+        else:
+            report = self._verifyAll(repair, chunkSize)
+        report['repaired'] = bool(repair and (report['missing'] or
+                                              report['stale']))
+        report['upgraded'] = False
+        if repair and not isinstance(self.__inverseMapping, GroupMapping):
+            self._upgradeInverseMapping(chunkSize)
+            report['upgraded'] = True
+        if repair or not (report['missing'] or report['stale']):
+            self._v_touched = set()
+        return report
+
+    def _upgradeInverseMapping(self, chunkSize):
+        # containers created before GroupMapping use a plain OOBTree which
+        # doesn't merge concurrent changes of the groups of a principal
+        mapping = GroupMapping()
+        items = self.__inverseMapping.items()
+        for i, (pid, groups) in enumerate(items, 1):
+            mapping[pid] = groups
+            if i % chunkSize == 0:
+                transaction.savepoint(optimistic=True)
+        self.__inverseMapping = mapping
+
+    def _verifyAll(self, repair, chunkSize):
+        data = self._SampleContainer__data
+        mapping = self.__inverseMapping
+        jar = self._p_jar
+        expected = BTrees.OOBTree.OOBTree()
+        count = 0
+        for gid, group in data.items():
+            for pid in group.principals:
+                groups = expected.get(pid, ())
+                if gid not in groups:
+                    expected[pid] = groups + (gid,)
+            count += 1
+            if jar is not None and count % chunkSize == 0:
+                # the scan is read only, release the loaded groups
+                jar.cacheGC()
+
+        missing = stale = 0
+        wrong = []
+        for i, (pid, groups) in enumerate(mapping.items(), 1):
+            if pid not in expected:
+                stale += len(groups)
+                wrong.append(pid)
+            if jar is not None and i % chunkSize == 0:
+                jar.cacheGC()
+        for pid, groups in expected.items():
+            current = mapping.get(pid, ())
+            if current != groups:
+                added = len(set(groups) - set(current))
+                removed = len(current) - (len(groups) - added)
+                if added or removed:
+                    missing += added
+                    stale += removed
+                    wrong.append(pid)
+
+        if repair:
+            for i, pid in enumerate(wrong, 1):
+                self._setGroups(pid, expected.get(pid, ()))
+                if i % chunkSize == 0:
+                    transaction.savepoint(optimistic=True)
+        return {'checked': count, 'principals': len(wrong),
+                'missing': missing, 'stale': stale}
+
+    def _verifyTouched(self, repair, chunkSize):
+        mapping = self.__inverseMapping
+        touched = sorted(self._v_touched)
+        missing = stale = 0
+        wrong = set()
+        for pid, gid in touched:
+            group = self.get(gid)
+            member = group is not None and pid in group.principals
+            groups = mapping.get(pid, ())
+            mapped = groups.count(gid)
+            if member and not mapped:
+                missing += 1
+            elif mapped > member:
+                stale += mapped - member
+            else:
+                continue
+            wrong.add(pid)
+            if repair:
+                groups = tuple([id for id in groups if id != gid])
+                if member:
+                    groups += (gid,)
+                self._setGroups(pid, groups)
+                if len(wrong) % chunkSize == 0:
+                    transaction.savepoint(optimistic=True)
+        return {'checked': len(touched), 'principals': len(wrong),
+                'missing': missing, 'stale': stale}
+
     def search(self, query, start=None, batch_size=None):
         """ Search for groups"""
         search = query.get('search')
+        if search is not None and query.get('sort') == 'relevance':
+            yield from rankResults(
+                ((relevance(search, groupinfo.title,
+                            description=groupinfo.description),
+                  groupinfo.title.lower(), id)
+                 for id, groupinfo in self.items()),
+                start, batch_size)
+            return
         if search is not None:
-            n = 0
             search = search.lower()
-            for i, (id, groupinfo) in enumerate(self.items()):
-                if (search in groupinfo.title.lower() or
-                    (groupinfo.description and
-                     search in groupinfo.description.lower())):
-                    if not ((start is not None and i < start) or
-                            (batch_size is not None and n >= batch_size)):
-                        n += 1
-                        yield id
+            found = (id for id, groupinfo in self.items()
+                     if (search in groupinfo.title.lower() or
+                         (groupinfo.description and
+                          search in groupinfo.description.lower())))
+            # once the batch is complete the others don't get scanned
+            start = start or 0
+            stop = None if batch_size is None else start + batch_size
+            yield from itertools.islice(found, start, stop)
 
     def authenticateCredentials(self, credentials):
         # group container don't authenticate
@@ -201,6 +566,14 @@ class GroupContainer(btree.BTreeContainer):
     def queryPrincipal(self, id, default=None):
         return self.get(id, default)
 
+    def queryPrincipals(self, ids):
+        groups = {}
+        for id in ids:
+            group = self.get(id)
+            if group is not None:
+                groups[id] = group
+        return groups
+
 
 class GroupCycle(Exception):
     """There is a cyclic relationship among groups."""
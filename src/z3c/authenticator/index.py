@@ -0,0 +1,227 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""User Attribute Indexes and Search Ranking
+"""
+import heapq
+
+import BTrees.OOBTree
+import persistent
+import zope.interface
+
+from z3c.authenticator import interfaces
+
+
+class IndexBase(persistent.Persistent):
+    """Index of an attribute of the users in a user container."""
+
+    def __init__(self, attribute):
+        self.attribute = attribute
+        self.clear()
+
+    def clear(self):
+        # value -> ids and id -> values
+        self._fwd = BTrees.OOBTree.OOBTree()
+        self._rev = BTrees.OOBTree.OOBTree()
+
+    def _values(self, obj):
+        """Return the indexed values of the user, None if there are none.
+
+        By default the attribute holds a single value, subclasses override
+        this for other kinds of attributes.
+        """
+        value = getattr(obj, self.attribute, None)
+        if value is None:
+            return None
+        return (value,)
+
+    def index(self, id, obj):
+        values = self._values(obj)
+        old = self._rev.get(id)
+        if old == values:
+            return
+        if old is not None:
+            self.unindex(id)
+        if not values:
+            return
+        for value in values:
+            ids = self._fwd.get(value)
+            if ids is None:
+                ids = self._fwd[value] = BTrees.OOBTree.OOTreeSet()
+            ids.add(id)
+        self._rev[id] = values
+
+    def unindex(self, id):
+        values = self._rev.pop(id, None)
+        for value in values or ():
+            ids = self._fwd.get(value)
+            if ids is not None:
+                ids.remove(id)
+                if not ids:
+                    del self._fwd[value]
+
+    def _apply(self, values):
+        result = None
+        for value in values:
+            ids = self._fwd.get(value)
+            if ids is not None:
+                result = BTrees.OOBTree.union(result, ids)
+        return result
+
+    def __len__(self):
+        return len(self._rev)
+
+
+@zope.interface.implementer(interfaces.IUserIndex)
+class FieldIndex(IndexBase):
+    """Index of a single value attribute.
+
+    >>> from z3c.authenticator.user import User
+    >>> index = FieldIndex('title')
+    >>> index.index(u'u1', User(u'max', u'passwd', u'Max'))
+    >>> index.index(u'u2', User(u'moritz', u'passwd', u'Moritz'))
+    >>> index.index(u'u3', User(u'fritz', u'passwd', u'Max'))
+
+    >>> list(index.apply(u'Max'))
+    ['u1', 'u3']
+
+    Any of a list of values can get queried:
+
+    >>> list(index.apply([u'Moritz', u'Bolte']))
+    ['u2']
+
+    >>> index.unindex(u'u1')
+    >>> list(index.apply(u'Max'))
+    ['u3']
+    >>> list(index.apply(u'Bolte'))
+    []
+    """
+
+    def apply(self, query):
+        if isinstance(query, (list, tuple, set, frozenset)):
+            values = query
+        else:
+            values = (query,)
+        result = self._apply(values)
+        return BTrees.OOBTree.OOTreeSet() if result is None else result
+
+
+@zope.interface.implementer(interfaces.IUserIndex)
+class KeywordIndex(IndexBase):
+    """Index of an attribute providing a sequence of keywords.
+
+    >>> from z3c.authenticator.user import User
+    >>> index = KeywordIndex('roles')
+    >>> max = User(u'max', u'passwd', u'Max')
+    >>> max.roles = (u'editor', u'reviewer')
+    >>> moritz = User(u'moritz', u'passwd', u'Moritz')
+    >>> moritz.roles = (u'editor',)
+    >>> index.index(u'u1', max)
+    >>> index.index(u'u2', moritz)
+
+    Users having any of the given keywords get returned:
+
+    >>> list(index.apply(u'editor'))
+    ['u1', 'u2']
+    >>> list(index.apply([u'reviewer', u'manager']))
+    ['u1']
+
+    >>> moritz.roles = ()
+    >>> index.index(u'u2', moritz)
+    >>> list(index.apply(u'editor'))
+    ['u1']
+    """
+
+    def _values(self, obj):
+        values = getattr(obj, self.attribute, None)
+        if values is None:
+            return None
+        if isinstance(values, str):
+            values = (values,)
+        return tuple(sorted(set(values)))
+
+    def apply(self, query):
+        if isinstance(query, str):
+            query = (query,)
+        result = self._apply(query)
+        return BTrees.OOBTree.OOTreeSet() if result is None else result
+
+
+# relevance scores, lower is better
+EXACT_LOGIN = 0
+PREFIX = 1
+TITLE_TOKEN = 2
+SUBSTRING = 3
+DESCRIPTION = 4
+
+
+def relevance(search, title, login=None, description=None):
+    """Return the relevance score of a principal for a search string.
+
+    An exact login match is best, then a login or title prefix, then a
+    word of the title starting with the search string, then any substring
+    of login and title and last the description:
+
+    >>> relevance(u'max', u'Max Muster', u'max')
+    0
+    >>> relevance(u'max', u'Maximilian', u'maxi')
+    1
+    >>> relevance(u'max', u'Muster Max', u'muster')
+    2
+    >>> relevance(u'max', u'Hamax', u'hamax')
+    3
+    >>> relevance(u'max', u'Moritz', u'moritz', u'Friend of Max')
+    4
+
+    Non matching principals have no score:
+
+    >>> relevance(u'max', u'Moritz', u'moritz') is None
+    True
+    """
+    search = search.lower()
+    title = (title or '').lower()
+    login = (login or '').lower()
+    if login and login == search:
+        return EXACT_LOGIN
+    if title.startswith(search) or (login and login.startswith(search)):
+        return PREFIX
+    if any(word.startswith(search) for word in title.split()):
+        return TITLE_TOKEN
+    if search in title or search in login:
+        return SUBSTRING
+    if description and search in description.lower():
+        return DESCRIPTION
+    return None
+
+
+def rankResults(candidates, start=None, batch_size=None):
+    """Return the ids of the best scored candidates.
+
+    The candidates are (score, sort key, id) tuples, candidates without a
+    score get skipped. Only the top start + batch_size candidates are kept
+    in a heap:
+
+    >>> candidates = [(2, u'b', 'id2'), (None, u'x', 'id9'),
+    ...               (0, u'c', 'id3'), (2, u'a', 'id1')]
+    >>> rankResults(candidates)
+    ['id3', 'id1', 'id2']
+    >>> rankResults(candidates, start=1, batch_size=1)
+    ['id1']
+    """
+    candidates = (item for item in candidates if item[0] is not None)
+    start = start or 0
+    if batch_size is None:
+        ranked = sorted(candidates)
+    else:
+        ranked = heapq.nsmallest(start + batch_size, candidates)
+    return [item[-1] for item in ranked[start:]]
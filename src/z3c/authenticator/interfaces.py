@@ -53,7 +53,37 @@ class IAuthenticatorPlugin(IPlugin):
         """
 
 
-class IPrincipalRegistryAuthenticatorPlugin(IAuthenticatorPlugin):
+class IBulkAuthenticatorPlugin(IAuthenticatorPlugin):
+    """Authenticator plugin able to look up many principals at once."""
+
+    def queryPrincipals(ids):
+        """Returns a mapping of the given ids to IPrincipal objects.
+
+        Ids the plugin cannot find information for are omitted.
+        """
+
+
+class ISearchable(zope.interface.Interface):
+    """An interface for searching using schema-constrained input."""
+
+    def search(query, start=None, batch_size=None):
+        """Returns an iteration of principal IDs matching the query.
+
+        query is a mapping of name/value pairs for fields specified by the
+        schema.
+
+        If the start argument is provided, then it should be an
+        integer and the given number of initial items should be
+        skipped.
+
+        If the batch_size argument is provided, then it should be an
+        integer and no more than the given number of items should be
+        returned.
+        """
+
+
+class IPrincipalRegistryAuthenticatorPlugin(IBulkAuthenticatorPlugin,
+                                            ISearchable):
     """Principal registry authenticator plugin.
 
     This plugin is a little bit special since principals get returned from
@@ -65,6 +95,9 @@ class IPrincipalRegistryAuthenticatorPlugin(IAuthenticatorPlugin):
 
     You can trun of this feature by set allowQueryPrincipal to False.
     Anyway, this is just an optional plugin, you don't have to use it.
+
+    The search uses a sorted index of the logins and titles of the registry
+    principals and matches prefixes like the registry's getPrincipals.
     """
 
     allowQueryPrincipal = zope.schema.Bool(
@@ -113,22 +146,33 @@ class ICredentialsPlugin(IPlugin):
         """
 
 
-class ISearchable(zope.interface.Interface):
-    """An interface for searching using schema-constrained input."""
+class IClientAddress(zope.interface.Interface):
+    """The address of the client sending a request.
 
-    def search(query, start=None, batch_size=None):
-        """Returns an iteration of principal IDs matching the query.
+    An optional adapter of the request, used to throttle failed
+    authentications per client address. Register one if the address is not
+    available from REMOTE_ADDR or a trusted X-Forwarded-For header.
+    """
 
-        query is a mapping of name/value pairs for fields specified by the
-        schema.
+    address = zope.interface.Attribute(
+        'The client address or None if it is unknown.')
 
-        If the start argument is provided, then it should be an
-        integer and the given number of initial items should be
-        skipped.
 
-        If the batch_size argument is provided, then it should be an
-        integer and no more than the given number of items should be
-        returned.
+class IChallengeSelector(zope.interface.Interface):
+    """Selects the credentials plugins challenging a request.
+
+    An adapter of the Authenticator and the request. It allows to route a
+    challenge or a logout to a credentials plugin based on the request,
+    e.g. the path or the accepted content types, without asking the other
+    plugins first.
+    """
+
+    def select(method):
+        """Return the names of the credentials plugins to try first.
+
+        The method is 'challenge' or 'logout'. If none of the selected plugins
+        issues a challenge, the other credentials plugins get asked as usual.
+        Return None to ask all credentials plugins.
         """
 
 
@@ -151,6 +195,69 @@ class IAuthenticator(ILogout, IContainer):
         default=True,
     )
 
+    concurrentPrincipalLookup = zope.schema.Bool(
+        title=_('Concurrent principal lookup'),
+        description=_('Query the authenticator plugins concurrently in '
+                      'getPrincipal. The principal of the first plugin in '
+                      'authenticatorPlugins order still wins.'),
+        default=False,
+    )
+
+    principalLookupTimeout = zope.schema.Float(
+        title=_('Principal lookup timeout'),
+        description=_('Seconds to wait for the concurrently queried '
+                      'plugins, counted from the start of the lookup. '
+                      'Plugins not answering in time count as a miss and '
+                      'get skipped until that lookup is done.'),
+        required=False,
+        min=0.0,
+        default=5.0,
+    )
+
+    collectStatistics = zope.schema.Bool(
+        title=_('Collect statistics'),
+        description=_('Record timings and counters for authenticate, '
+                      'getPrincipal, unauthorized and logout.'),
+        default=False,
+    )
+
+    failedCredentialsTimeout = zope.schema.Float(
+        title=_('Failed credentials timeout'),
+        description=_('Seconds failed credentials get rejected without '
+                      'checking them again. Logins and client addresses '
+                      'failing too often get rejected with an exponential '
+                      'backoff starting at this timeout. Not set disables '
+                      'the rejection.'),
+        required=False,
+        min=0.0,
+        default=None,
+    )
+
+    maxFailedAttempts = zope.schema.Int(
+        title=_('Maximum failed attempts'),
+        description=_('Failed authentications of a login or a client '
+                      'address before the backoff starts.'),
+        min=1,
+        default=5,
+    )
+
+    throttleAddresses = zope.schema.Bool(
+        title=_('Reject failing client addresses'),
+        description=_('Reject client addresses failing too often. Behind a '
+                      'proxy, list it in the trusted proxies, otherwise all '
+                      'clients share the address of the proxy.'),
+        default=False,
+    )
+
+    trustedProxies = zope.schema.Tuple(
+        title=_('Trusted proxies'),
+        description=_('Addresses of the proxies whose X-Forwarded-For '
+                      'header gets used to find the client address.'),
+        value_type=zope.schema.TextLine(),
+        required=False,
+        default=(),
+    )
+
     credentialsPlugins = zope.schema.List(
         title=_('Credentials Plugins'),
         description=_("""Used for extracting credentials.
@@ -190,6 +297,72 @@ class IAuthenticator(ILogout, IContainer):
     def logout(request):
         """Performs a logout by delegating to its authenticator plugins."""
 
+    def queryPrincipals(ids):
+        """Returns a mapping of the given ids to found principals.
+
+        This is the bulk version of getPrincipal. The authenticator plugins
+        get asked for the ids not found so far, IBulkAuthenticatorPlugin
+        plugins with all of them at once. Ids not found at all are omitted.
+        """
+
+    def search(query, start=None, batch_size=None):
+        """Returns an iteration of principal ids of all queriables.
+
+        The results of the queriables returned by getQueriables get merged
+        round-robin. The searches of the queriables are consumed lazily, only
+        as far as needed for the requested batch. See ISearchable.search.
+        """
+
+    def searchPage(query, cursor=None, batch_size=20):
+        """Return a page of principal ids of all queriables and a cursor.
+
+        The ids get merged round-robin like in search. The returned cursor
+        contains the number of ids consumed from every queriable which may
+        have more results, they get passed as start to its search. Passing
+        the cursor in again returns the next page. The cursor is None if all
+        queriables are exhausted. The searches are not asked for more ids
+        than needed, so the last page may be empty.
+
+        An id found by several queriables is returned once per page. The
+        cursor doesn't keep the returned ids, so such an id may show up again
+        on a later page.
+        """
+
+    def getStatistics():
+        """Return the IAuthenticatorStatistics of this authenticator.
+
+        Statistics get only recorded if collectStatistics is enabled.
+        """
+
+
+class IAuthenticatorStatistics(zope.interface.Interface):
+    """In memory timings and counters of an IAuthenticator.
+
+    Timings get recorded per operation, e.g. ``authenticate``, and per
+    operation and plugin name, e.g. ``queryPrincipal`` of the ``users``
+    plugin. Counters count hits, misses and next utility fallbacks.
+    """
+
+    def record(operation, seconds, plugin=None):
+        """Record the time used by an operation (of a plugin)."""
+
+    def increment(counter, amount=1):
+        """Increment the given counter."""
+
+    def timer(operation, plugin=None):
+        """Context manager recording the time used by its block."""
+
+    def report():
+        """Return the timings and counters as mapping.
+
+        The mapping provides the keys ``timings`` (by operation), ``plugins``
+        (by operation and plugin name) and ``counters``. Each timing is a
+        mapping with the keys ``count``, ``total`` and ``max`` (seconds).
+        """
+
+    def reset():
+        """Remove all timings and counters."""
+
 
 # user interfaces
 class IUser(zope.interface.Interface):
@@ -229,6 +402,28 @@ class IUser(zope.interface.Interface):
         default='')
 
 
+class IUserIndex(zope.interface.Interface):
+    """Index of a user attribute used by IUserContainer.search."""
+
+    attribute = zope.interface.Attribute("The name of the indexed attribute.")
+
+    def index(id, user):
+        """Index the attribute value of the user with the given id."""
+
+    def unindex(id):
+        """Remove the user with the given id from the index."""
+
+    def apply(query):
+        """Return the sorted ids of the users matching the query.
+
+        The query is a value or a list of values, users matching any of them
+        get returned.
+        """
+
+    def clear():
+        """Remove all users from the index."""
+
+
 class ISourceSearchCriteria(zope.interface.Interface):
     """Search Interface for this Principal Provider"""
 
@@ -240,17 +435,68 @@ class ISourceSearchCriteria(zope.interface.Interface):
         missing_value='')
 
 
-class IUserContainer(IContainer, IAuthenticatorPlugin, ISearchable):
-    """Principal container."""
+class IUserContainer(IContainer, IBulkAuthenticatorPlugin, ISearchable):
+    """Principal container.
+
+    The search results get ranked by relevance if the query contains
+    ``sort`` set to ``relevance``.
+    """
 
     contains(IUser)
 
+    normalizeLogins = zope.schema.Bool(
+        title=_('Normalize logins'),
+        description=_('Look up logins case-insensitive and independent of '
+                      'the unicode normalization form. The normalized '
+                      'logins must be unique.'),
+        default=False,
+        required=False)
+
     def add(user):
         """Add a user and returns a the assigned token (principal id)."""
 
     def getUserByLogin(login):
         """Return the User object by looking it up by it's login"""
 
+    def addIndex(name, index):
+        """Add the IUserIndex under the given name and index all users.
+
+        The name can get used as key in the search query. The names
+        ``search`` and ``sort`` are reserved.
+        """
+
+    def removeIndex(name):
+        """Remove the index with the given name."""
+
+    def reindex(user):
+        """Update the indexes for the given user."""
+
+    def verifyLoginIndex(repair=False, cursor=None, chunkSize=1000,
+                         chunks=None):
+        """Verify the login index and rebuild it if repair is True.
+
+        Scans the users in id order and the index entries in login order in
+        chunks of chunkSize items. Stops after the given number of chunks if
+        chunks is not None.
+
+        Returns a dict with the number of checked items (checked), the number
+        of missing, wrong and stale index entries (missing, wrong, stale),
+        their sum (drift), the number of users sharing a login (duplicates),
+        whether the index got repaired (repaired) and the cursor to pass to
+        resume the verification, None if the verification is complete.
+        """
+
+
+class IShardedUserContainer(IUserContainer):
+    """User container spreading its users and logins over several BTrees."""
+
+    shards = zope.schema.Int(
+        title=_('Shards'),
+        description=_('The number of BTrees used for the users and logins.'),
+        default=16,
+        min=1,
+        readonly=True)
+
 
 # principal interfaces
 class IFoundPrincipal(zope.security.interfaces.IGroupClosureAwarePrincipal):
@@ -363,7 +609,7 @@ class IGroup(zope.security.interfaces.IGroup):
         required=False)
 
 
-class IGroupContainer(IContainer, IAuthenticatorPlugin, ISearchable):
+class IGroupContainer(IContainer, IBulkAuthenticatorPlugin, ISearchable):
 
     contains(IGroup)
 
@@ -381,6 +627,40 @@ class IGroupContainer(IContainer, IAuthenticatorPlugin, ISearchable):
     def getPrincipalsForGroup(groupid):
         """Get principals which belong to the group"""
 
+    def exportSnapshot():
+        """Export the groups, their members and titles as bytes.
+
+        The snapshot can get loaded into a group container using the same
+        prefix with importSnapshot.
+        """
+
+    def importSnapshot(data):
+        """Replace all groups with the groups of the given snapshot.
+
+        The groups get loaded without sending events or checking for cyclic
+        groups. Returns the number of loaded groups. Raises ValueError if the
+        data is not a valid snapshot or uses another prefix.
+        """
+
+    def verifyInverseMapping(repair=False, incremental=False, chunkSize=1000):
+        """Verify the mapping of principals to their groups.
+
+        Compares the groups returned by getGroupsForPrincipal with the
+        members of the groups. If repair is True, missing and stale entries
+        get fixed, with a savepoint after every chunkSize principals. If
+        incremental is True, only the memberships changed in this process
+        since the last verification get checked, as long as they are known.
+        Otherwise all groups get read, releasing them from the cache of the
+        connection after every chunkSize groups.
+
+        Returns a dict with the number of checked groups or memberships
+        (checked), the number of principals with wrong entries (principals),
+        the number of missing and stale entries (missing, stale), whether
+        the mapping got repaired (repaired) and whether the mapping of a
+        container created by an older version got upgraded to one merging
+        concurrent changes (upgraded), which requires repair.
+        """
+
 
 class IFoundGroup(IFoundPrincipal, zope.security.interfaces.IGroup):
     """IFoundGroup acts as a IFoundPrincipal representing a group.
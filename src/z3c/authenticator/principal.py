@@ -13,14 +13,88 @@
 ##############################################################################
 """Principal
 """
+import weakref
+
 import zope.component
 import zope.interface
+import zope.security.management
 from zope.authentication.interfaces import IAuthentication
+from zope.authentication.interfaces import PrincipalLookupError
 from zope.security.interfaces import IPrincipal
 
 from z3c.authenticator import interfaces
 
 
+# direct groups of groups by interaction and authentication utility
+_closures = weakref.WeakKeyDictionary()
+
+
+def _groupsCache(auth):
+    interaction = zope.security.management.queryInteraction()
+    if interaction is None:
+        return {}
+    try:
+        caches = _closures.setdefault(interaction, {})
+    except TypeError:
+        # not weak referenceable
+        return {}
+    return caches.setdefault(auth, {})
+
+
+def _lookupGroups(auth, ids):
+    if interfaces.IAuthenticator.providedBy(auth):
+        return auth.queryPrincipals(ids)
+    groups = {}
+    for id in ids:
+        try:
+            groups[id] = auth.getPrincipal(id)
+        except PrincipalLookupError:
+            pass
+    return groups
+
+
+def groupClosure(groups):
+    """Iterate the given group ids and the ids of all their groups.
+
+    The groups get resolved breadth first. All groups of one level get looked
+    up at once using the bulk lookup of the authentication utility. The
+    groups of a group are remembered for the current interaction.
+    """
+    if not groups:
+        return
+    auth = zope.component.getUtility(IAuthentication)
+    cache = _groupsCache(auth)
+    seen = set()
+    frontier = []
+    for group_id in groups:
+        if group_id not in seen:
+            seen.add(group_id)
+            frontier.append(group_id)
+            yield group_id
+    while frontier:
+        unknown = [group_id for group_id in frontier if group_id not in cache]
+        if unknown:
+            found = _lookupGroups(auth, unknown)
+            for group_id in unknown:
+                cache[group_id] = tuple(
+                    getattr(found.get(group_id), 'groups', None) or ())
+        level = []
+        for group_id in frontier:
+            for parent_id in cache[group_id]:
+                if parent_id not in seen:
+                    seen.add(parent_id)
+                    level.append(parent_id)
+                    yield parent_id
+        frontier = level
+
+
+def invalidateGroupClosures(event):
+    """Forget the groups of groups remembered for the current interaction."""
+    interaction = zope.security.management.queryInteraction()
+    if interaction is not None:
+        _closures.pop(interaction, None)
+
+
 class PrincipalBase:
     """Base class for IAuthenticatedPrincipal and IFoundPrincipal principals.
     """
@@ -37,21 +111,7 @@ class PrincipalBase:
     @property
     def allGroups(self):
         """This method is not used in zope by default, but nice to have it."""
-        if self.groups:
-            seen = set()
-            auth = zope.component.getUtility(IAuthentication)
-            stack = [iter(self.groups)]
-            while stack:
-                try:
-                    group_id = next(stack[-1])
-                except StopIteration:
-                    stack.pop()
-                else:
-                    if group_id not in seen:
-                        yield group_id
-                        seen.add(group_id)
-                        group = auth.getPrincipal(group_id)
-                        stack.append(iter(group.groups))
+        return groupClosure(self.groups)
 
     def __repr__(self):
         return f"<{self.__class__.__name__} {self.id}>"
@@ -81,6 +141,41 @@ class FoundPrincipalForPrincipal(PrincipalBase):
     """IFoundPrincipal principal for IPrincipal."""
 
 
+class CompactPrincipalBase:
+    """Base class for principals using ``__slots__``.
+
+    The principal copies the id, the title and the description of the user
+    and keeps no reference to it. Reading the id loads the state of a
+    persistent user anyway, so the attributes get copied while its
+    connection is known to be valid. The principals have no instance
+    dictionary, subscribers can't set additional attributes.
+    """
+
+    __slots__ = ('id', 'title', 'description', 'groups', '__provides__')
+
+    __init__ = PrincipalBase.__init__
+
+    allGroups = PrincipalBase.allGroups
+
+    __repr__ = PrincipalBase.__repr__
+
+
+@zope.component.adapter(interfaces.IUser)
+@zope.interface.implementer(interfaces.IAuthenticatedPrincipal)
+class CompactAuthenticatedPrincipal(CompactPrincipalBase):
+    """IAuthenticatedPrincipal principal using ``__slots__``."""
+
+    __slots__ = ()
+
+
+@zope.component.adapter(interfaces.IUser)
+@zope.interface.implementer(interfaces.IFoundPrincipal)
+class CompactFoundPrincipal(CompactPrincipalBase):
+    """IFoundPrincipal principal using ``__slots__``."""
+
+    __slots__ = ()
+
+
 @zope.interface.implementer(interfaces.IFoundGroup)
 @zope.component.adapter(zope.security.interfaces.IGroup)
 class FoundGroup:
@@ -92,21 +187,7 @@ class FoundGroup:
 
     @property
     def allGroups(self):
-        if self.groups:
-            seen = set()
-            auth = zope.component.getUtility(IAuthentication)
-            stack = [iter(self.groups)]
-            while stack:
-                try:
-                    group_id = stack[-1].next()
-                except StopIteration:
-                    stack.pop()
-                else:
-                    if group_id not in seen:
-                        yield group_id
-                        seen.add(group_id)
-                        group = auth.getPrincipal(group_id)
-                        stack.append(iter(group.groups))
+        return groupClosure(self.groups)
 
     @property
     def title(self):
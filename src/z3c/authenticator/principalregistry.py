@@ -13,6 +13,11 @@
 ##############################################################################
 """Principal Registry
 """
+import bisect
+import collections
+import itertools
+import threading
+
 import persistent
 import zope.interface
 from zope.authentication.interfaces import PrincipalLookupError
@@ -21,6 +26,155 @@ from zope.principalregistry.principalregistry import principalRegistry
 from zope.schema.fieldproperty import FieldProperty
 
 from z3c.authenticator import interfaces
+from z3c.authenticator.throttle import credentialsDigest
+
+
+class RegistryIndex:
+    """Sorted index of the lower case logins and titles of principals.
+
+    >>> principals = [
+    ...     principalRegistry.definePrincipal(id, title, login=login)
+    ...     for id, title, login in (('s1', u'Service Mail', u'mail'),
+    ...                              ('s2', u'Service Backup', u'backup'),
+    ...                              ('s3', u'Mailer', u'mailer'))]
+    >>> index = RegistryIndex(principals)
+    >>> len(index)
+    3
+
+    Logins and titles get searched by prefix:
+
+    >>> list(index.search(u'mail'))
+    ['s1', 's3']
+    >>> list(index.search(u'SERVICE'))
+    ['s2', 's1']
+    >>> list(index.search(u'b'))
+    ['s2']
+    >>> list(index.search(u'x'))
+    []
+    """
+
+    def __init__(self, principals):
+        entries = set()
+        ids = set()
+        for principal in principals:
+            ids.add(principal.id)
+            entries.add((principal.title.lower(), principal.id))
+            login = principal.getLogin()
+            if login:
+                entries.add((login.lower(), principal.id))
+        entries = sorted(entries)
+        self._keys = [key for key, id in entries]
+        self._ids = [id for key, id in entries]
+        self._size = len(ids)
+
+    def __len__(self):
+        return self._size
+
+    def search(self, prefix):
+        """Yield the ids of the principals matching prefix in key order."""
+        prefix = prefix.lower()
+        seen = set()
+        for i in range(bisect.bisect_left(self._keys, prefix),
+                       len(self._keys)):
+            if not self._keys[i].startswith(prefix):
+                break
+            id = self._ids[i]
+            if id not in seen:
+                seen.add(id)
+                yield id
+
+
+_registryIndex = None
+_registryIndexLock = threading.Lock()
+
+
+def _registryState():
+    # principals can get defined after the index got built; the registry
+    # doesn't notify, so we compare the state of its principal mapping
+    principals = getattr(
+        principalRegistry, '_PrincipalRegistry__principalsById', None)
+    if principals is None:  # pragma: no cover
+        return None
+    return id(principals), len(principals)
+
+
+def getRegistryIndex():
+    """Return the RegistryIndex of the global principal registry.
+
+    The index gets built on first use or at startup and again if
+    principals got defined since.
+    """
+    global _registryIndex
+    state = _registryState()
+    index = _registryIndex
+    if index is None or state is None or index[0] != state:
+        with _registryIndexLock:
+            index = _registryIndex
+            if index is None or state is None or index[0] != state:
+                index = _registryIndex = (
+                    state, RegistryIndex(principalRegistry.getPrincipals('')))
+    return index[1]
+
+
+def buildRegistryIndex(event=None):
+    """Build the registry index, a subscriber for IDatabaseOpened."""
+    getRegistryIndex()
+
+
+# principals and their credentials state by keyed digest of verified
+# credentials, and the registry state they are valid for
+MAX_VERIFIED_CREDENTIALS = 1000
+_verified = collections.OrderedDict()
+_verifiedState = None
+_verifiedLock = threading.Lock()
+
+
+def _credentialsState(principal):
+    # a principal can get redefined with another password without changing
+    # the registry state, so the verified principal gets compared with the
+    # registered one on every hit
+    return (principal.id, principal.getLogin(),
+            getattr(principal, '_Principal__pw', None),
+            getattr(principal, '_Principal__pwManagerName', None))
+
+
+def _getVerified(key, state, login):
+    global _verifiedState
+    with _verifiedLock:
+        if _verifiedState != state:
+            # the registry got reloaded
+            _verified.clear()
+            _verifiedState = state
+        entry = _verified.get(key)
+        if entry is None:
+            return None
+        principal, credentials = entry
+        try:
+            current = principalRegistry.getPrincipalByLogin(login)
+        except KeyError:
+            current = None
+        if current is not principal or \
+                _credentialsState(current) != credentials:
+            del _verified[key]
+            return None
+        _verified.move_to_end(key)
+        return principal
+
+
+def _setVerified(key, state, principal):
+    with _verifiedLock:
+        if _verifiedState == state:
+            _verified[key] = (principal, _credentialsState(principal))
+            if len(_verified) > MAX_VERIFIED_CREDENTIALS:
+                _verified.popitem(last=False)
+
+
+def _clear():
+    global _registryIndex, _verifiedState
+    _registryIndex = None
+    with _verifiedLock:
+        _verified.clear()
+        _verifiedState = None
 
 
 @zope.interface.implementer(interfaces.IPrincipalRegistryAuthenticatorPlugin)
@@ -43,10 +197,25 @@ class PrincipalRegistryAuthenticatorPlugin(persistent.Persistent,
         if not ('login' in credentials and 'password' in credentials):
             return None
 
+        # a principal verified before doesn't need to pay the password hash
+        # cost again as long as it is registered with the same password
+        state = _registryState()
+        try:
+            key = credentialsDigest(credentials['login'],
+                                    credentials['password'])
+        except TypeError:
+            key = None
+        if key is not None and state is not None:
+            p = _getVerified(key, state, credentials['login'])
+            if p is not None:
+                return p
+
         # get the principal from the principal registry and validate
         try:
             p = principalRegistry.getPrincipalByLogin(credentials['login'])
             if p.validate(credentials["password"]):
+                if key is not None and state is not None:
+                    _setVerified(key, state, p)
                 return p
         except KeyError:
             return None
@@ -63,3 +232,36 @@ class PrincipalRegistryAuthenticatorPlugin(persistent.Persistent,
             except PrincipalLookupError:
                 pass
         return default
+
+    def queryPrincipals(self, ids):
+        principals = {}
+        if self.allowQueryPrincipal:
+            for id in ids:
+                try:
+                    principal = principalRegistry.getPrincipal(id)
+                except PrincipalLookupError:
+                    continue
+                if principal is not None:
+                    principals[id] = principal
+        return principals
+
+    def search(self, query, start=None, batch_size=None):
+        # found ids can't get looked up without allowQueryPrincipal
+        search = query.get('search')
+        if not search or not self.allowQueryPrincipal:
+            return
+        ids = getRegistryIndex().search(search)
+        start = start or 0
+        stop = None if batch_size is None else start + batch_size
+        yield from itertools.islice(ids, start, stop)
+
+
+# Register our cleanup with Testing.CleanUp to make writing unit tests
+# simpler.
+try:
+    from zope.testing.cleanup import addCleanUp
+except ModuleNotFoundError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(_clear)
+    del addCleanUp
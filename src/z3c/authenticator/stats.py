@@ -0,0 +1,123 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Authenticator Statistics
+"""
+import contextlib
+import threading
+import time
+
+import zope.interface
+
+from z3c.authenticator import interfaces
+from z3c.authenticator.volatile import VolatileRegistry
+
+
+@zope.interface.implementer(interfaces.IAuthenticatorStatistics)
+class AuthenticatorStatistics:
+    """Timings and counters collected by an Authenticator.
+
+    The statistics live in memory and are shared by all threads of the
+    process using the same Authenticator:
+
+    >>> from zope.interface.verify import verifyObject
+    >>> stats = AuthenticatorStatistics()
+    >>> verifyObject(interfaces.IAuthenticatorStatistics, stats)
+    True
+
+    >>> stats.record('getPrincipal', 0.5)
+    >>> stats.record('getPrincipal', 1.5)
+    >>> stats.record('queryPrincipal', 0.25, 'users')
+    >>> stats.increment('getPrincipal.hits')
+    >>> stats.increment('getPrincipal.hits')
+
+    >>> data = stats.report()
+    >>> data['timings']['getPrincipal']
+    {'count': 2, 'total': 2.0, 'max': 1.5}
+    >>> data['plugins']['queryPrincipal']
+    {'users': {'count': 1, 'total': 0.25, 'max': 0.25}}
+    >>> data['counters']
+    {'getPrincipal.hits': 2}
+
+    >>> stats.reset()
+    >>> stats.report()
+    {'timings': {}, 'plugins': {}, 'counters': {}}
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._timings = {}
+            self._counters = {}
+
+    def record(self, operation, seconds, plugin=None):
+        key = (operation, plugin)
+        with self._lock:
+            timing = self._timings.get(key)
+            if timing is None:
+                self._timings[key] = [1, seconds, seconds]
+            else:
+                timing[0] += 1
+                timing[1] += seconds
+                if seconds > timing[2]:
+                    timing[2] = seconds
+
+    def increment(self, counter, amount=1):
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + amount
+
+    @contextlib.contextmanager
+    def timer(self, operation, plugin=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(operation, time.perf_counter() - start, plugin)
+
+    def report(self):
+        timings = {}
+        plugins = {}
+        with self._lock:
+            items = sorted(self._timings.items(),
+                           key=lambda item: (item[0][0], item[0][1] or ''))
+            for (operation, plugin), (count, total, max_) in items:
+                data = {'count': count, 'total': total, 'max': max_}
+                if plugin is None:
+                    timings[operation] = data
+                else:
+                    plugins.setdefault(operation, {})[plugin] = data
+            counters = dict(sorted(self._counters.items()))
+        return {'timings': timings, 'plugins': plugins, 'counters': counters}
+
+
+# statistics by authenticator, see getStatistics
+_statistics = VolatileRegistry(AuthenticatorStatistics)
+
+
+def getStatistics(authenticator):
+    """Return the AuthenticatorStatistics of the given authenticator."""
+    return _statistics.get(authenticator)
+
+
+def timedCall(stats, operation, plugin, method, *args):
+    """Call method and record the time used if stats is not None."""
+    if stats is None:
+        return method(*args)
+    start = time.perf_counter()
+    try:
+        return method(*args)
+    finally:
+        stats.record(operation, time.perf_counter() - start, plugin)
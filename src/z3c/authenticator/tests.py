@@ -12,21 +12,53 @@
 #
 ##############################################################################
 import doctest
+import json
+import os
+import shutil
+import tempfile
+import types
 import unittest
 
+import persistent
+import persistent.mapping
+import transaction
+import zope.authentication.interfaces
+import zope.authentication.principal
+import zope.component.event
 import zope.component.testing
+import zope.interface
 import zope.password.testing
+import zope.schema
 import zope.site.testing
 from z3c.testing import BaseTestIContainer
 from z3c.testing import InterfaceBaseTest
+from ZODB.DB import DB
+from ZODB.FileStorage import FileStorage
+from zope.component import hooks
+from zope.container.contained import Contained
+from zope.dublincore.interfaces import IDCDescriptiveProperties
+from zope.lifecycleevent import ObjectAddedEvent
+from zope.lifecycleevent import ObjectModifiedEvent
+from zope.lifecycleevent import ObjectRemovedEvent
+from zope.lifecycleevent.interfaces import IObjectMovedEvent
+from zope.password.interfaces import IPasswordManager
+from zope.principalregistry.principalregistry import principalRegistry
+from zope.publisher.browser import TestRequest
 
 from z3c.authenticator import authentication
+from z3c.authenticator import benchmark
 from z3c.authenticator import credential
+from z3c.authenticator import event
 from z3c.authenticator import group
 from z3c.authenticator import interfaces
 from z3c.authenticator import principal
+from z3c.authenticator import principalregistry
 from z3c.authenticator import testing
 from z3c.authenticator import user
+from z3c.authenticator import vocabulary
+from z3c.authenticator import widget
+from z3c.authenticator.browser import authenticator as browser
+from z3c.authenticator.browser.authenticator import PrincipalSearch
 
 
 class AuthenticatorTest(BaseTestIContainer):
@@ -52,6 +84,15 @@ class UserContainerTest(InterfaceBaseTest):
         return user.UserContainer
 
 
+class ShardedUserContainerTest(InterfaceBaseTest):
+
+    def getTestInterface(self):
+        return interfaces.IShardedUserContainer
+
+    def getTestClass(self):
+        return user.ShardedUserContainer
+
+
 class UserTest(InterfaceBaseTest):
 
     def setUp(self):
@@ -67,6 +108,10 @@ class UserTest(InterfaceBaseTest):
         return ('login', 'password', 'Title')
 
 
+class IMarker(zope.interface.Interface):
+    pass
+
+
 class AuthenticatedPrincipalTest(InterfaceBaseTest):
 
     def setUp(self):
@@ -82,6 +127,16 @@ class AuthenticatedPrincipalTest(InterfaceBaseTest):
         usr = user.User('login', 'password', 'Title')
         return principal.AuthenticatedPrincipal(usr)
 
+    def test_extend(self):
+        # IPrincipalCreated subscribers can extend principals and events
+        found = self.makeTestObject()
+        found.email = 'login@example.com'
+        created = event.AuthenticatedPrincipalCreated(None, found, None)
+        zope.interface.alsoProvides(created, IMarker)
+        zope.interface.alsoProvides(found, IMarker)
+        self.assertEqual(found.email, 'login@example.com')
+        self.assertTrue(IMarker.providedBy(created))
+
 
 class FoundPrincipalTest(InterfaceBaseTest):
 
@@ -99,6 +154,64 @@ class FoundPrincipalTest(InterfaceBaseTest):
         return principal.FoundPrincipal(usr)
 
 
+class CompactAuthenticatedPrincipalTest(InterfaceBaseTest):
+
+    def setUp(self):
+        testing.setUpPasswordManager()
+
+    def getTestInterface(self):
+        return interfaces.IAuthenticatedPrincipal
+
+    def getTestClass(self):
+        return principal.CompactAuthenticatedPrincipal
+
+    def makeTestObject(self):
+        usr = user.User('login', 'password', 'Title')
+        return principal.CompactAuthenticatedPrincipal(usr)
+
+
+class CompactFoundPrincipalTest(InterfaceBaseTest):
+
+    def setUp(self):
+        testing.setUpPasswordManager()
+
+    def getTestInterface(self):
+        return interfaces.IFoundPrincipal
+
+    def getTestClass(self):
+        return principal.CompactFoundPrincipal
+
+    def makeTestObject(self):
+        usr = user.User('login', 'password', 'Title')
+        return principal.CompactFoundPrincipal(usr)
+
+
+class CompactPrincipalConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        testing.setUpPasswordManager()
+        self.db = DB(None)
+
+    def tearDown(self):
+        transaction.abort()
+        self.db.close()
+
+    def test_closed_connection(self):
+        # the principal keeps no reference to the user and its connection
+        conn = self.db.open()
+        conn.root()['users'] = user.UserContainer()
+        uid, usr = conn.root()['users'].add(
+            user.User('compact', 'secret', 'Compact'))
+        transaction.commit()
+        conn.cacheMinimize()
+        found = principal.CompactFoundPrincipal(conn.root()['users'][uid])
+        conn.close()
+        self.assertEqual(found.id, uid)
+        self.assertEqual(found.title, 'Compact')
+        self.assertEqual(found.description, '')
+        self.assertFalse(hasattr(found, '__dict__'))
+
+
 class GroupContainerTest(InterfaceBaseTest):
 
     def getTestInterface(self):
@@ -147,6 +260,891 @@ class SessionCredentialsPluginFormTest(InterfaceBaseTest):
         return credential.SessionCredentialsPlugin
 
 
+class BenchmarkTest(unittest.TestCase):
+
+    def setUp(self):
+        zope.component.testing.setUp()
+
+    def tearDown(self):
+        zope.component.testing.tearDown()
+
+    def test_run(self):
+        report = benchmark.run(sizes=(20,), iterations=2, depth=3,
+                               imports=False)
+        names = [result['name'] for result in report['results']]
+        self.assertIn('Authenticator.authenticate (basic)', names)
+        self.assertIn('Authenticator.getPrincipal (3 nested groups)', names)
+        self.assertIn('Authenticator.getPrincipal (memory, compact)', names)
+        for result in report['results']:
+            self.assertEqual(result['size'], 20)
+            self.assertNotIn('retry_rate', result)
+            if 'min' in result:
+                self.assertLessEqual(result['min'], result['max'])
+            else:
+                self.assertGreaterEqual(result['peak_bytes'], 0)
+
+    def test_conflicts(self):
+        benchmark.setUpComponents()
+        result = benchmark.benchmarkConflicts(2, 4, size=20)
+        self.assertEqual(result['commits'], 8)
+        self.assertEqual(result['failures'], 0)
+
+
+class ShardedTreeConflictTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = DB(FileStorage(os.path.join(self.tmpdir, 'Data.fs')))
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_concurrent_adds(self):
+        # adding keys of different shards concurrently doesn't conflict
+        tm1 = transaction.TransactionManager()
+        tm2 = transaction.TransactionManager()
+        conn1 = self.db.open(tm1)
+        conn2 = self.db.open(tm2)
+        conn1.root()['tree'] = user.ShardedTree(4)
+        tm1.commit()
+        tm2.begin()
+        keys = {}
+        for key in ('a', 'b', 'c', 'd', 'e', 'f'):
+            keys.setdefault(user.shardKey(key, 4), key)
+        first, second = list(keys.values())[:2]
+        conn1.root()['tree'][first] = 1
+        conn2.root()['tree'][second] = 2
+        tm1.commit()
+        tm2.commit()
+        tm1.begin()
+        tree = conn1.root()['tree']
+        self.assertEqual(len(tree), 2)
+        self.assertEqual(list(tree.items()),
+                         sorted([(first, 1), (second, 2)]))
+        conn1.close()
+        conn2.close()
+
+
+class GroupConflictTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = DB(FileStorage(os.path.join(self.tmpdir, 'Data.fs')))
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_concurrent_group_changes(self):
+        # concurrent changes of the groups of a principal get merged
+        tm1 = transaction.TransactionManager()
+        tm2 = transaction.TransactionManager()
+        conn1 = self.db.open(tm1)
+        conn2 = self.db.open(tm2)
+        groups = conn1.root()['groups'] = group.GroupContainer('groups.')
+        for name in ('a', 'b', 'c'):
+            groups.addGroup(name, group.Group(name))
+        groups['groups.a'].setPrincipals(['p1'], False)
+        tm1.commit()
+        tm2.begin()
+
+        groups1 = conn1.root()['groups']
+        groups2 = conn2.root()['groups']
+        groups1['groups.b'].setPrincipals(['p1'], False)
+        groups2['groups.a'].setPrincipals([], False)
+        groups2['groups.c'].setPrincipals(['p1'], False)
+        tm1.commit()
+        tm2.commit()
+
+        tm1.begin()
+        self.assertEqual(groups1.getGroupsForPrincipal('p1'),
+                         ('groups.b', 'groups.c'))
+        report = groups1.verifyInverseMapping()
+        self.assertEqual(report['missing'] + report['stale'], 0)
+        tm1.abort()
+        conn1.close()
+        conn2.close()
+
+    def test_concurrent_new_principal(self):
+        # two transactions adding the first group of the same principal get
+        # merged, with the mapping stored inline and in separate buckets
+        for count in (0, 100):
+            tm1 = transaction.TransactionManager()
+            tm2 = transaction.TransactionManager()
+            conn1 = self.db.open(tm1)
+            conn2 = self.db.open(tm2)
+            groups = conn1.root()['groups'] = group.GroupContainer('groups.')
+            groups.addGroup('a', group.Group('a'))
+            groups.addGroup('b', group.Group('b'))
+            members = ()
+            for i in range(count):
+                # added in key order, so no bucket is full and 'new' doesn't
+                # split a bucket, conflicting splits can't get merged
+                members += ('p%03d' % i,)
+                groups['groups.a'].setPrincipals(members, False)
+            tm1.commit()
+            tm2.begin()
+
+            groups1 = conn1.root()['groups']
+            groups2 = conn2.root()['groups']
+            groups1['groups.a'].setPrincipals(
+                groups1['groups.a'].principals + ('new',), False)
+            groups2['groups.b'].setPrincipals(['new'], False)
+            tm1.commit()
+            tm2.commit()
+
+            tm1.begin()
+            self.assertEqual(groups1.getGroupsForPrincipal('new'),
+                             ('groups.a', 'groups.b'))
+            tm1.abort()
+            conn1.close()
+            conn2.close()
+
+    def test_verify_chunks(self):
+        # the full verification releases the loaded groups every chunk
+        conn = self.db.open()
+        groups = conn.root()['groups'] = group.GroupContainer('groups.')
+        for i in range(5):
+            groups.addGroup('g%s' % i, group.Group('g%s' % i))
+            groups['groups.g%s' % i].setPrincipals(['p%s' % i], False)
+        transaction.commit()
+        calls = []
+        conn.cacheGC = lambda: calls.append(True)
+        report = groups.verifyInverseMapping(chunkSize=2)
+        self.assertEqual(report['missing'] + report['stale'], 0)
+        self.assertEqual(report['checked'], 5)
+        # two chunks of groups and two chunks of mapped principals
+        self.assertEqual(len(calls), 4)
+        transaction.abort()
+        conn.close()
+
+
+@zope.interface.implementer(zope.schema.interfaces.ISourceQueriables)
+class FakeQueriables:
+
+    def getQueriables(self):
+        return []
+
+
+class FakeTerms:
+
+    def getTerm(self, value):
+        return widget.PrincipalTerm(value, value.upper())
+
+    def getTermByToken(self, token):
+        return self.getTerm(token)
+
+    def getValue(self, token):
+        return token
+
+
+class PrincipalSourceWidgetTest(unittest.TestCase):
+
+    def setUp(self):
+        zope.component.testing.setUp()
+
+    def tearDown(self):
+        zope.component.testing.tearDown()
+
+    def getWidget(self, form):
+        field = zope.schema.List(
+            __name__='members',
+            value_type=zope.schema.Choice(values=['p']))
+        request = TestRequest(form=form)
+        result = widget.PrincipalSourceWidget(
+            field, FakeQueriables(), request)
+        result.name = result.id = 'members'
+        result.terms = FakeTerms()
+        result.batchSize = 3
+        return result
+
+    def test_pages(self):
+        tokens = ['p%d' % i for i in range(7)]
+        result = self.getWidget({'members': tokens + ['p1'],
+                                 'members-page': '1'})
+        result.update()
+        # only the current page gets rendered, duplicates get dropped
+        self.assertEqual([item['value'] for item in result.items],
+                         ['p3', 'p4', 'p5'])
+        self.assertEqual(result.hiddenTokens, ['p0', 'p1', 'p2', 'p6'])
+        self.assertEqual([page['current'] for page in result.pages],
+                         [False, True, False])
+
+    def test_addValue(self):
+        result = self.getWidget({'members': ['p0', 'p1']})
+        result.update()
+        self.assertEqual(result.pages, [])
+        result.addValue('p1')
+        result.addValue('p2')
+        self.assertEqual(
+            [(item['value'], item['checked']) for item in result.items],
+            [('p0', True), ('p1', True), ('p2', False)])
+
+
+@zope.interface.implementer(interfaces.IAuthenticator)
+class FakeAuthenticator:
+
+    def __init__(self):
+        self.lookups = []
+
+    def queryPrincipals(self, ids):
+        self.lookups.append(list(ids))
+        return {id: principal.FoundGroup(group.Group(id.title()))
+                for id in ids if id != 'unknown'}
+
+
+class PrincipalTermsTest(unittest.TestCase):
+
+    def setUp(self):
+        zope.component.testing.setUp()
+        self.auth = FakeAuthenticator()
+        zope.component.provideUtility(
+            self.auth, zope.authentication.interfaces.IAuthentication)
+
+    def tearDown(self):
+        zope.component.testing.tearDown()
+
+    def getTerms(self, request):
+        field = zope.schema.List(
+            value_type=zope.schema.Choice(
+                source=zope.authentication.principal.PrincipalSource()))
+        return widget.PrincipalTerms(None, request, None, field, None)
+
+    def test_getTerms(self):
+        request = TestRequest()
+        terms = self.getTerms(request)
+        result = terms.getTerms(['max', 'unknown', 'moritz'])
+        self.assertEqual([term.title for term in result], ['Max', 'Moritz'])
+        self.assertEqual(self.auth.lookups, [['max', 'unknown', 'moritz']])
+        self.assertEqual(terms.getValue(result[0].token), 'max')
+        self.assertRaises(LookupError, terms.getTerm, 'unknown')
+
+        # the terms get cached for the request
+        other = self.getTerms(request)
+        self.assertEqual(other.getTermByToken(result[1].token).title,
+                         'Moritz')
+        self.assertEqual(len(self.auth.lookups), 1)
+
+    def test_converter(self):
+        terms = self.getTerms(TestRequest())
+        converter = widget.PrincipalSourceDataConverter(
+            terms.field, types.SimpleNamespace(terms=terms))
+        self.assertEqual(converter.toWidgetValue(['moritz', 'max']),
+                         [widget.toToken('moritz'), widget.toToken('max')])
+        # unknown principals are an error like with getTerm
+        with self.assertRaises(LookupError) as raised:
+            converter.toWidgetValue(['max', 'unknown'])
+        self.assertEqual(raised.exception.args, ('unknown',))
+
+
+def setUpSearch():
+    """Return an Authenticator with five users and two groups to search."""
+    zope.password.testing.setUpPasswordManagers()
+    zope.component.provideAdapter(
+        authentication.QueriableAuthenticator,
+        (interfaces.ISearchable, interfaces.IAuthenticator),
+        interfaces.IQueriableAuthenticator)
+    zope.component.provideAdapter(
+        principal.FoundPrincipal, provides=interfaces.IFoundPrincipal)
+    zope.component.provideAdapter(
+        principal.FoundGroup, provides=interfaces.IFoundPrincipal)
+    auth = authentication.Authenticator()
+    users = auth['users'] = user.UserContainer()
+    ids = [users.add(user.User('user%d' % i, 'secret', 'User %d' % i,
+                               'Description of user %d' % i))[0]
+           for i in range(5)]
+    groups = auth['groups'] = group.GroupContainer('groups.')
+    for i in range(2):
+        groups.addGroup('g%d' % i, group.Group(
+            'Group %d' % i, 'Description of group %d' % i))
+    auth.authenticatorPlugins = ('users', 'groups')
+    return auth, ids
+
+
+class PrincipalSearchTest(unittest.TestCase):
+
+    def setUp(self):
+        zope.component.testing.setUp()
+        self.auth, self.users = setUpSearch()
+
+    def tearDown(self):
+        zope.component.testing.tearDown()
+
+    def search(self, **form):
+        request = TestRequest(form=form)
+        view = PrincipalSearch(self.auth, request)
+        result = view()
+        return request.response, json.loads(result)
+
+    def test_search(self):
+        response, data = self.search(q='user', limit='3')
+        self.assertEqual(response.getHeader('Content-Type'),
+                         'application/json')
+        self.assertEqual(len(data['results']), 3)
+        self.assertEqual((data['more'], data['next']), (True, 3))
+        titles = [item['title'] for item in data['results']]
+        response, data = self.search(q='user', limit='3', start='3')
+        self.assertEqual(len(data['results']), 2)
+        self.assertEqual((data['more'], data['next']), (False, None))
+        titles += [item['title'] for item in data['results']]
+        self.assertEqual(sorted(titles), ['User %d' % i for i in range(5)])
+
+    def test_search_queriables(self):
+        response, data = self.search(q='of', limit='10')
+        self.assertEqual([item['queriable'] for item in data['results']],
+                         ['users'] * 5 + ['groups'] * 2)
+        self.assertEqual(data['results'][-1],
+                         {'id': 'groups.g1', 'title': 'Group 1',
+                          'queriable': 'groups'})
+
+    def test_limits(self):
+        self.assertEqual(self.search(q='u')[1]['results'], [])
+        view = PrincipalSearch
+        response, data = self.search(q='user', limit='1000')
+        self.assertLessEqual(len(data['results']), view.maxLimit)
+        response, data = self.search(q='user', limit='x')
+        self.assertEqual(len(data['results']), 5)
+
+    def test_cache(self):
+        data = self.search(q='user 1')[1]
+        self.assertEqual(len(data['results']), 1)
+        del self.auth['users'][data['results'][0]['id']]
+        # the result gets reused for a short time
+        self.assertEqual(self.search(q='User 1')[1], data)
+
+    def test_rate_limit(self):
+        view = PrincipalSearch
+        for i in range(view.rateLimit):
+            response, data = self.search(q='user %d' % i)
+            self.assertEqual(response.getStatus(), 200)
+        response, data = self.search(q='user')
+        self.assertEqual(response.getStatus(), 429)
+        self.assertEqual(data, {'error': 'Too many requests'})
+        self.assertLessEqual(int(response.getHeader('Retry-After')),
+                             view.rateWindow)
+
+    def test_rate_limit_principals(self):
+        def retryAfter(id, now):
+            request = TestRequest()
+            request.setPrincipal(types.SimpleNamespace(id=id))
+            return PrincipalSearch(self.auth, request)._retryAfter(now)
+        for id in ('p1', 'p2', 'p3'):
+            self.assertIsNone(retryAfter(id, 0.0))
+        # idle principals get forgotten
+        self.assertIsNone(retryAfter('p1', PrincipalSearch.rateWindow))
+        self.assertEqual(list(browser._searchRequests), ['p1'])
+        # the number of remembered principals is bounded
+        PrincipalSearch.rateLimitedPrincipals = 2
+        try:
+            for id in ('p2', 'p3'):
+                self.assertIsNone(retryAfter(id, PrincipalSearch.rateWindow))
+        finally:
+            PrincipalSearch.rateLimitedPrincipals = 10000
+        self.assertEqual(list(browser._searchRequests), ['p2', 'p3'])
+
+
+class FederatedSearchTest(unittest.TestCase):
+
+    def setUp(self):
+        zope.component.testing.setUp()
+        self.auth, self.users = setUpSearch()
+        principalRegistry.definePrincipal(
+            'zope.officer', 'Officer', login='officer')
+        self.auth['registry'] = (
+            principalregistry.PrincipalRegistryAuthenticatorPlugin())
+        self.auth.authenticatorPlugins = ('users', 'groups', 'registry')
+
+    def tearDown(self):
+        zope.component.testing.tearDown()
+
+    def kinds(self, ids):
+        return ''.join('u' if id in self.users else
+                       'g' if id.startswith('groups.') else 'r'
+                       for id in ids)
+
+    def test_search(self):
+        # the queriables get merged round-robin
+        ids = list(self.auth.search({'search': 'of'}))
+        self.assertEqual(self.kinds(ids), 'ugruguuu')
+        self.assertEqual(
+            list(self.auth.search({'search': 'of'}, start=2, batch_size=3)),
+            ids[2:5])
+        self.assertEqual(list(self.auth.search({'search': 'unknown'})), [])
+
+    def test_search_lazy(self):
+        consumed = []
+
+        def search(query, start=None, batch_size=None):
+            for id in self.users:
+                consumed.append(id)
+                yield id
+        self.auth['users'].search = search
+        self.assertEqual(
+            len(list(self.auth.search({'search': 'of'}, batch_size=4))), 4)
+        self.assertEqual(len(consumed), 2)
+
+    def test_searchPage(self):
+        ids, cursor = self.auth.searchPage({'search': 'of'}, batch_size=4)
+        self.assertEqual(self.kinds(ids), 'ugru')
+        self.assertEqual(cursor,
+                         (('users', 2), ('groups', 1), ('registry', 1)))
+        more, cursor = self.auth.searchPage({'search': 'of'}, cursor, 2)
+        self.assertEqual(self.kinds(more), 'ug')
+        self.assertEqual(cursor,
+                         (('users', 3), ('groups', 2), ('registry', 1)))
+        rest, cursor = self.auth.searchPage({'search': 'of'}, cursor, 10)
+        self.assertEqual(self.kinds(rest), 'uu')
+        self.assertIsNone(cursor)
+        self.assertEqual(sorted(ids + more + rest),
+                         sorted(self.auth.search({'search': 'of'})))
+
+    def test_searchPage_start(self):
+        # the consumed ids get skipped by the searches of the queriables
+        starts = []
+        search = self.auth['users'].search
+
+        def tracked(query, start=None, batch_size=None):
+            starts.append(start)
+            return search(query, start, batch_size)
+        self.auth['users'].search = tracked
+        ids, cursor = self.auth.searchPage({'search': 'user'}, batch_size=2)
+        more, cursor = self.auth.searchPage({'search': 'user'}, cursor, 2)
+        self.assertEqual(starts, [0, 2])
+        self.assertEqual(ids + more, sorted(self.users)[:4])
+
+    def test_searchPage_duplicates(self):
+        self.auth['other'] = (
+            principalregistry.PrincipalRegistryAuthenticatorPlugin())
+        self.auth.authenticatorPlugins = ('registry', 'other')
+        self.assertEqual(self.auth.searchPage({'search': 'off'}),
+                         (['zope.officer'], None))
+
+    def test_registry(self):
+        registry = self.auth['registry']
+        self.assertEqual(list(registry.search({'search': 'OFF'})),
+                         ['zope.officer'])
+        # principals defined later get indexed too
+        principalRegistry.definePrincipal(
+            'zope.offline', 'Backup', login='offline')
+        self.assertEqual(list(registry.search({'search': 'off'})),
+                         ['zope.officer', 'zope.offline'])
+        self.assertEqual(list(registry.search({'search': 'off'}, 1, 1)),
+                         ['zope.offline'])
+        self.assertEqual(
+            sorted(registry.queryPrincipals(
+                ['zope.offline', 'unknown', 'zope.officer'])),
+            ['zope.officer', 'zope.offline'])
+        registry.allowQueryPrincipal = False
+        self.assertEqual(registry.queryPrincipals(['zope.officer']), {})
+        self.assertEqual(list(registry.search({'search': 'off'})), [])
+
+    def test_container_search_start(self):
+        # start skips matching users, not users
+        users = self.auth['users']
+        self.assertEqual(list(users.search({'search': 'user 3'})),
+                         [self.users[3]])
+        self.assertEqual(list(users.search({'search': 'user 3'}, 1)), [])
+        self.assertEqual(
+            list(self.auth['groups'].search({'search': 'group 1'}, 0, 1)),
+            ['groups.g1'])
+        self.assertEqual(
+            list(self.auth['groups'].search({'search': 'group 1'}, 1)), [])
+
+    def test_container_search_stops(self):
+        # a filled batch doesn't scan the remaining users
+        users = self.auth['users']
+        found = users.search({'search': 'user'}, batch_size=2)
+        self.assertEqual(len(list(found)), 2)
+        scanned = []
+        values = users.values
+
+        def tracked():
+            for value in values():
+                scanned.append(value)
+                yield value
+        users.values = tracked
+        list(users.search({'search': 'user'}, batch_size=2))
+        self.assertEqual(len(scanned), 2)
+
+
+@zope.interface.implementer(IPasswordManager)
+class CountingPasswordManager:
+
+    def __init__(self):
+        self.checks = 0
+
+    def checkPassword(self, encoded, password):
+        self.checks += 1
+        return encoded == password
+
+
+class RegistryCredentialsTest(unittest.TestCase):
+
+    def setUp(self):
+        zope.component.testing.setUp()
+        self.manager = CountingPasswordManager()
+        zope.component.provideUtility(self.manager, name='Counting')
+        principalRegistry.definePrincipal(
+            'zope.mgr', 'Manager', login='mgr', password='secret',
+            passwordManagerName='Counting')
+        self.plugin = principalregistry.PrincipalRegistryAuthenticatorPlugin()
+
+    def tearDown(self):
+        zope.component.testing.tearDown()
+
+    def authenticate(self, login, password):
+        return self.plugin.authenticateCredentials(
+            {'login': login, 'password': password})
+
+    def test_cache(self):
+        self.assertEqual(self.authenticate('mgr', 'secret').id, 'zope.mgr')
+        self.assertEqual(self.authenticate('mgr', 'secret').id, 'zope.mgr')
+        self.assertEqual(self.manager.checks, 1)
+        # wrong passwords don't hit the cache
+        self.assertIsNone(self.authenticate('mgr', 'wrong'))
+        self.assertIsNone(self.authenticate('mgr', 'wrong'))
+        self.assertIsNone(self.authenticate('unknown', 'secret'))
+        self.assertEqual(self.manager.checks, 3)
+
+    def test_reload(self):
+        self.authenticate('mgr', 'secret')
+        # reloading the registry drops the verified credentials
+        zope.component.testing.tearDown()
+        zope.component.testing.setUp()
+        zope.component.provideUtility(self.manager, name='Counting')
+        principalRegistry.definePrincipal(
+            'zope.mgr', 'Manager', login='mgr', password='other',
+            passwordManagerName='Counting')
+        self.assertIsNone(self.authenticate('mgr', 'secret'))
+        self.assertEqual(self.authenticate('mgr', 'other').id, 'zope.mgr')
+
+    def test_redefine(self):
+        self.authenticate('mgr', 'secret')
+        # redefining a principal keeps the size of the registry
+        del principalRegistry._PrincipalRegistry__principalsById['zope.mgr']
+        del principalRegistry._PrincipalRegistry__principalsByLogin['mgr']
+        principalRegistry.definePrincipal(
+            'zope.mgr', 'Manager', login='mgr', password='other',
+            passwordManagerName='Counting')
+        self.assertIsNone(self.authenticate('mgr', 'secret'))
+        self.assertEqual(self.authenticate('mgr', 'other').id, 'zope.mgr')
+        # changing the password of the registered principal
+        p = principalRegistry.getPrincipalByLogin('mgr')
+        p._Principal__pw = 'third'
+        self.assertIsNone(self.authenticate('mgr', 'other'))
+        self.assertEqual(self.authenticate('mgr', 'third').id, 'zope.mgr')
+
+    def test_bounded(self):
+        for id in ('other', 'third'):
+            principalRegistry.definePrincipal(
+                'zope.' + id, id.title(), login=id, password='secret',
+                passwordManagerName='Counting')
+        principalregistry.MAX_VERIFIED_CREDENTIALS = 2
+        try:
+            for login in ('mgr', 'other', 'third', 'other'):
+                self.authenticate(login, 'secret')
+        finally:
+            principalregistry.MAX_VERIFIED_CREDENTIALS = 1000
+        # the least recently used principal got dropped
+        self.assertEqual(
+            [p.id for p, state in principalregistry._verified.values()],
+            ['zope.third', 'zope.other'])
+        self.assertEqual(self.manager.checks, 3)
+
+
+@zope.interface.implementer(interfaces.ICredentialsPlugin)
+class TitledPlugin(persistent.Persistent, Contained):
+
+    def __init__(self, title):
+        # stored outside of the plugin like a dublin core title
+        self.info = persistent.mapping.PersistentMapping(title=title)
+
+
+@zope.component.adapter(TitledPlugin)
+@zope.interface.implementer(IDCDescriptiveProperties)
+class TitledPluginDC:
+
+    def __init__(self, context):
+        self.title = context.info['title']
+
+
+@zope.component.adapter(zope.interface.Interface)
+@zope.interface.implementer(zope.component.IComponentLookup)
+def getSiteManager(context):
+    return zope.component.getGlobalSiteManager()
+
+
+class VocabularyCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        zope.component.testing.setUp()
+        zope.component.provideAdapter(TitledPluginDC)
+        zope.component.provideAdapter(getSiteManager)
+        self.db = DB(None)
+        self.tm1 = transaction.TransactionManager()
+        self.tm2 = transaction.TransactionManager()
+        self.conn1 = self.db.open(self.tm1)
+        self.conn2 = self.db.open(self.tm2)
+        auth = self.conn1.root()['auth'] = authentication.Authenticator()
+        auth['plugin'] = TitledPlugin('Old')
+        self.tm1.commit()
+        self.tm2.begin()
+
+    def tearDown(self):
+        self.conn1.close()
+        self.conn2.close()
+        self.db.close()
+        zope.component.testing.tearDown()
+
+    def titles(self, conn):
+        return [term.title.mapping['name'] for term in
+                vocabulary.credentialsPlugins(conn.root()['auth'])]
+
+    def setTitle(self, conn, title):
+        plugin = conn.root()['auth']['plugin']
+        plugin.info['title'] = title
+        vocabulary.pluginModified(plugin, ObjectModifiedEvent(plugin))
+
+    def test_other_connection(self):
+        self.assertEqual(self.titles(self.conn1), ['Old'])
+        self.setTitle(self.conn2, 'New')
+        self.tm2.commit()
+        self.tm1.begin()
+        self.assertEqual(self.titles(self.conn1), ['New'])
+
+    def test_abort(self):
+        self.assertEqual(self.titles(self.conn1), ['Old'])
+        self.setTitle(self.conn1, 'New')
+        self.assertEqual(self.titles(self.conn1), ['New'])
+        self.tm1.abort()
+        self.assertEqual(self.titles(self.conn1), ['Old'])
+
+    def test_no_plugin_write(self):
+        self.assertEqual(self.titles(self.conn1), ['Old'])
+        plugin = self.conn1.root()['auth']['plugin']
+        vocabulary.pluginModified(plugin, ObjectModifiedEvent(plugin))
+        # only the version gets modified, not the plugin
+        self.assertFalse(plugin._p_changed)
+        self.tm1.commit()
+        self.tm2.begin()
+        self.assertEqual(self.titles(self.conn2), ['Old'])
+
+    def test_moved(self):
+        self.assertEqual(self.titles(self.conn1), ['Old'])
+        auth = self.conn2.root()['auth']
+        plugin = auth['plugin']
+        del auth['plugin']
+        vocabulary.pluginMoved(plugin, ObjectRemovedEvent(plugin, auth))
+        auth['plugin'] = TitledPlugin('Replaced')
+        vocabulary.pluginMoved(
+            auth['plugin'], ObjectAddedEvent(auth['plugin'], auth))
+        self.tm2.commit()
+        self.tm1.begin()
+        self.assertEqual(self.titles(self.conn1), ['Replaced'])
+
+    def test_old_authenticator(self):
+        auth = self.conn1.root()['auth']
+        del auth._pluginsVersion
+        self.tm1.commit()
+        self.assertEqual(self.titles(self.conn1), ['Old'])
+        self.setTitle(self.conn1, 'New')
+        self.assertIsNotNone(auth._pluginsVersion)
+        self.tm1.commit()
+        self.tm2.begin()
+        self.assertEqual(self.titles(self.conn2), ['New'])
+
+
+@zope.interface.implementer(interfaces.ICredentialsPlugin)
+class ChallengePlugin:
+
+    def __init__(self, calls, name, protocol=None, result=False):
+        self.calls = calls
+        self.name = name
+        self.challengeProtocol = protocol
+        self.result = result
+
+    def extractCredentials(self, request):
+        return None
+
+    def challenge(self, request):
+        self.calls.append(self.name)
+        return self.result
+
+    def logout(self, request):
+        self.calls.append(self.name)
+        return self.result
+
+
+class PersistentChallengePlugin(persistent.Persistent, Contained,
+                                ChallengePlugin):
+    pass
+
+
+class APIChallengeSelector(authentication.ChallengeSelector):
+
+    pathPrefixes = (('/api/', ('api',)),)
+
+
+class ChallengeTest(unittest.TestCase):
+
+    def setUp(self):
+        zope.component.testing.setUp()
+        self.calls = []
+        self.auth = authentication.Authenticator()
+        for name, protocol, result in (('form', None, False),
+                                       ('basic', 'http', True),
+                                       ('other', None, True),
+                                       ('digest', 'http', False),
+                                       ('api', 'token', True)):
+            self.auth[name] = ChallengePlugin(
+                self.calls, name, protocol, result)
+        self.auth.credentialsPlugins = (
+            'form', 'basic', 'other', 'digest', 'api')
+
+    def tearDown(self):
+        zope.component.testing.tearDown()
+
+    def test_protocol(self):
+        # after the first challenge only plugins of the same protocol
+        self.auth.unauthorized(None, TestRequest())
+        self.assertEqual(self.calls, ['form', 'basic', 'digest'])
+        del self.calls[:]
+        self.auth.logout(TestRequest())
+        self.assertEqual(self.calls, ['form', 'basic', 'digest'])
+
+    def test_plan(self):
+        plan = self.auth._challengePlan()
+        self.assertIs(self.auth._challengePlan(), plan)
+        self.assertEqual(
+            {protocol: [name for name, plugin in plugins]
+             for protocol, plugins in plan[1].items()},
+            {'http': ['basic', 'digest'], 'token': ['api']})
+        # the plan gets rebuilt if credentialsPlugins or a plugin changes
+        self.auth.credentialsPlugins = ('api', 'form')
+        self.assertEqual(
+            [step[:2] for step in self.auth._challengePlan()[0]],
+            [('api', 'token'), ('form', None)])
+        zope.component.provideHandler(zope.component.event.objectEventNotify)
+        zope.component.provideHandler(
+            vocabulary.pluginMoved, (interfaces.IPlugin, IObjectMovedEvent))
+        del self.auth['api']
+        self.auth['api'] = ChallengePlugin(self.calls, 'api', 'bearer')
+        self.assertEqual(
+            [step[:2] for step in self.auth._challengePlan()[0]],
+            [('api', 'bearer'), ('form', None)])
+
+    def test_plan_version(self):
+        db = DB(None)
+        tm = transaction.TransactionManager()
+        conn = db.open(tm)
+        auth = conn.root()['auth'] = authentication.Authenticator()
+        auth['token'] = PersistentChallengePlugin([], 'token', 'token')
+        auth.credentialsPlugins = ('token',)
+        tm.commit()
+        plan = auth._challengePlan()
+        self.assertIs(auth._challengePlan(), plan)
+        # changed plugins don't get cached until the commit
+        auth['token'].challengeProtocol = 'bearer'
+        vocabulary.pluginModified(
+            auth['token'], ObjectModifiedEvent(auth['token']))
+        plan = auth._challengePlan()
+        self.assertEqual([step[:2] for step in plan[0]],
+                         [('token', 'bearer')])
+        self.assertIsNot(auth._challengePlan(), plan)
+        tm.commit()
+        plan = auth._challengePlan()
+        self.assertIs(auth._challengePlan(), plan)
+        conn.close()
+        db.close()
+
+    def test_selector(self):
+        zope.component.provideAdapter(
+            APIChallengeSelector, (interfaces.IAuthenticator, None))
+        request = TestRequest(environ={'PATH_INFO': '/api/users'})
+        self.auth.unauthorized(None, request)
+        self.assertEqual(self.calls, ['api'])
+        del self.calls[:]
+        # other requests get challenged as usual
+        self.auth.unauthorized(None, TestRequest())
+        self.assertEqual(self.calls, ['form', 'basic', 'digest'])
+        del self.calls[:]
+        # if the selected plugins don't challenge, the others get asked
+        self.auth['api'].result = False
+        self.auth.unauthorized(None, request)
+        self.assertEqual(self.calls, ['api', 'form', 'basic', 'digest'])
+
+
+@zope.interface.implementer(interfaces.IAuthenticatorPlugin)
+class LookupPlugin(Contained):
+
+    def __init__(self, principals, stored=False):
+        self.principals = principals
+        self.sites = []
+        if stored:
+            # gets queried in the calling thread like a stored plugin
+            self._p_jar = object()
+
+    def authenticateCredentials(self, credentials):
+        return None
+
+    def queryPrincipal(self, id, default=None):
+        self.sites.append(hooks.getSite())
+        return self.principals.get(id, default)
+
+
+class LookupSite:
+
+    def getSiteManager(self):
+        return zope.component.getGlobalSiteManager()
+
+
+class ConcurrentLookupTest(unittest.TestCase):
+
+    def setUp(self):
+        zope.component.testing.setUp()
+        zope.component.provideAdapter(getSiteManager)
+        self.auth = authentication.Authenticator()
+        self.auth.concurrentPrincipalLookup = True
+        self.remote = LookupPlugin({'remote': 'Remote', 'both': 'Remote'})
+        zope.component.provideUtility(
+            self.remote, interfaces.IAuthenticatorPlugin, 'remote')
+        self.stored = LookupPlugin({'both': 'Stored'}, True)
+        self.auth['stored'] = self.stored
+        self.auth.authenticatorPlugins = ('remote', 'stored')
+
+    def tearDown(self):
+        hooks.setSite()
+        zope.component.testing.tearDown()
+
+    def test_lazy_stored(self):
+        # stored plugins only get queried if the plugins before them missed
+        self.assertEqual(
+            self.auth._queryPrincipalConcurrently('both'), 'Remote')
+        self.assertEqual(self.stored.sites, [])
+        self.assertIsNone(self.auth._queryPrincipalConcurrently('unknown'))
+        self.assertEqual(len(self.stored.sites), 1)
+
+    def test_global_site(self):
+        # the workers don't use the site of the caller
+        site = LookupSite()
+        hooks.setSite(site)
+        self.auth.authenticatorPlugins = ('stored', 'remote')
+        self.assertEqual(
+            self.auth._queryPrincipalConcurrently('remote'), 'Remote')
+        self.assertEqual(self.stored.sites, [site])
+        self.assertEqual(self.remote.sites, [None])
+
+
+class ImportTest(unittest.TestCase):
+
+    def test_core_without_browser(self):
+        # the core modules don't need the widgets and browser views
+        core, full = benchmark.benchmarkImports(1)
+        self.assertEqual(core['loaded'], [])
+        self.assertIn('z3c.form', full['loaded'])
+
+
 def test_suite():
     loadTestsFromTestCase = unittest.defaultTestLoader.loadTestsFromTestCase
     return unittest.TestSuite((
@@ -160,6 +1158,10 @@ def test_suite():
             setUp=testing.placefulSetUp,
             tearDown=testing.placefulTearDown,
             optionflags=doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS),
+        doctest.DocTestSuite(
+            'z3c.authenticator.authentication',
+            setUp=zope.component.testing.setUp,
+            tearDown=zope.component.testing.tearDown),
         doctest.DocTestSuite(
             'z3c.authenticator.credential',
             setUp=testing.placefulSetUp,
@@ -169,25 +1171,65 @@ def test_suite():
             setUp=testing.placefulSetUp,
             tearDown=testing.placefulTearDown),
         doctest.DocTestSuite(
-            'z3c.authenticator.event',
+            'z3c.authenticator.index',
             setUp=testing.placefulSetUp,
             tearDown=testing.placefulTearDown),
+        doctest.DocTestSuite(
+            'z3c.authenticator.event',
+            setUp=zope.component.testing.setUp,
+            tearDown=zope.component.testing.tearDown),
         doctest.DocTestSuite(
             'z3c.authenticator.group',
             setUp=testing.placefulSetUp,
             tearDown=testing.placefulTearDown),
+        doctest.DocTestSuite(
+            'z3c.authenticator.principalregistry',
+            setUp=zope.component.testing.setUp,
+            tearDown=zope.component.testing.tearDown),
+        doctest.DocTestSuite(
+            'z3c.authenticator.widget',
+            setUp=zope.component.testing.setUp,
+            tearDown=zope.component.testing.tearDown),
+        doctest.DocTestSuite(
+            'z3c.authenticator.stats',
+            setUp=testing.placefulSetUp,
+            tearDown=testing.placefulTearDown),
+        doctest.DocTestSuite(
+            'z3c.authenticator.throttle',
+            setUp=zope.component.testing.setUp,
+            tearDown=zope.component.testing.tearDown),
+        doctest.DocTestSuite(
+            'z3c.authenticator.volatile',
+            setUp=zope.component.testing.setUp,
+            tearDown=zope.component.testing.tearDown),
         doctest.DocFileSuite(
             'vocabulary.txt',
             setUp=zope.component.testing.setUp,
             tearDown=zope.component.testing.tearDown),
         loadTestsFromTestCase(AuthenticatorTest),
         loadTestsFromTestCase(UserContainerTest),
+        loadTestsFromTestCase(ShardedUserContainerTest),
         loadTestsFromTestCase(UserTest),
         loadTestsFromTestCase(AuthenticatedPrincipalTest),
         loadTestsFromTestCase(FoundPrincipalTest),
+        loadTestsFromTestCase(CompactAuthenticatedPrincipalTest),
+        loadTestsFromTestCase(CompactFoundPrincipalTest),
+        loadTestsFromTestCase(CompactPrincipalConnectionTest),
         loadTestsFromTestCase(GroupContainerTest),
         loadTestsFromTestCase(GroupTest),
         loadTestsFromTestCase(SessionCredentialsTest),
         loadTestsFromTestCase(SessionCredentialsPluginTest),
         loadTestsFromTestCase(SessionCredentialsPluginFormTest),
+        loadTestsFromTestCase(ShardedTreeConflictTest),
+        loadTestsFromTestCase(GroupConflictTest),
+        loadTestsFromTestCase(PrincipalSourceWidgetTest),
+        loadTestsFromTestCase(PrincipalTermsTest),
+        loadTestsFromTestCase(PrincipalSearchTest),
+        loadTestsFromTestCase(FederatedSearchTest),
+        loadTestsFromTestCase(RegistryCredentialsTest),
+        loadTestsFromTestCase(VocabularyCacheTest),
+        loadTestsFromTestCase(ChallengeTest),
+        loadTestsFromTestCase(ConcurrentLookupTest),
+        loadTestsFromTestCase(BenchmarkTest),
+        loadTestsFromTestCase(ImportTest),
     ))
@@ -0,0 +1,257 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Failed Authentication Throttling
+"""
+import collections
+import hashlib
+import hmac
+import secrets
+import threading
+
+import zope.component
+import zope.interface
+
+from z3c.authenticator import interfaces
+from z3c.authenticator.volatile import VolatileRegistry
+
+
+# the longest backoff in seconds, counters expire after that time too
+MAX_BACKOFF = 300.0
+# the longest backoff of a login, anybody knowing the login can fail
+MAX_LOGIN_BACKOFF = 30.0
+# the number of remembered credentials and counters per authenticator
+MAX_ENTRIES = 10000
+
+# process local key of the credential digests, no plain passwords get kept
+_credentialsKey = secrets.token_bytes(32)
+
+
+def _asBytes(value):
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    return value
+
+
+def credentialsDigest(login, password):
+    """Return the keyed digest of a login and a password."""
+    login = _asBytes(login)
+    return hmac.new(
+        _credentialsKey,
+        b'%d:%s%s' % (len(login), login, _asBytes(password)),
+        hashlib.sha256).digest()
+
+
+def loginAndDigest(credentials):
+    """Return the login and the digest of login/password credentials.
+
+    Other credentials have neither:
+
+    >>> login, digest = loginAndDigest({'login': 'max', 'password': 'pw'})
+    >>> login, digest == credentialsDigest('max', 'pw')
+    ('max', True)
+    >>> loginAndDigest('token')
+    (None, None)
+    """
+    try:
+        login = credentials['login']
+        password = credentials['password']
+    except (TypeError, KeyError, IndexError):
+        return None, None
+    try:
+        return login, credentialsDigest(login, password)
+    except TypeError:
+        return None, None
+
+
+def clientAddress(request, trustedProxies=()):
+    """Return the client address of the request.
+
+    The environment gets used since request.get would accept a form value:
+
+    >>> from zope.publisher.browser import TestRequest
+    >>> request = TestRequest(environ={
+    ...     'REMOTE_ADDR': '10.0.0.1',
+    ...     'HTTP_X_FORWARDED_FOR': '192.0.2.7, 198.51.100.3'})
+    >>> clientAddress(request)
+    '10.0.0.1'
+
+    The X-Forwarded-For header only gets used if the request comes from a
+    trusted proxy. The last address not added by a trusted proxy is the
+    client address:
+
+    >>> clientAddress(request, ['10.0.0.1'])
+    '198.51.100.3'
+    >>> clientAddress(request, ['10.0.0.1', '198.51.100.3'])
+    '192.0.2.7'
+
+    An IClientAddress adapter of the request takes precedence:
+
+    >>> @zope.component.adapter(zope.interface.Interface)
+    ... @zope.interface.implementer(interfaces.IClientAddress)
+    ... class ClientAddress:
+    ...     def __init__(self, request):
+    ...         self.address = request.environment.get('HTTP_X_REAL_IP')
+    >>> zope.component.provideAdapter(ClientAddress)
+    >>> clientAddress(TestRequest(environ={'HTTP_X_REAL_IP': '192.0.2.9'}))
+    '192.0.2.9'
+    """
+    adapter = zope.component.queryAdapter(request, interfaces.IClientAddress)
+    if adapter is not None:
+        return adapter.address
+    environment = getattr(request, 'environment', None)
+    if environment is None:
+        return None
+    address = environment.get('REMOTE_ADDR') or None
+    if address in trustedProxies:
+        forwarded = environment.get('HTTP_X_FORWARDED_FOR', '').split(',')
+        for hop in reversed(forwarded):
+            hop = hop.strip()
+            if not hop:
+                break
+            address = hop
+            if hop not in trustedProxies:
+                break
+    return address
+
+
+class FailedAuthentications:
+    """Failed credentials and failure counters of an Authenticator.
+
+    Failed credentials get rejected for the given timeout without checking
+    them again:
+
+    >>> failures = FailedAuthentications()
+    >>> digest = credentialsDigest('max', 'wrong')
+    >>> failures.isBlocked(0.0, digest, 'max')
+    False
+    >>> failures.failed(0.0, 2.0, 3, digest, 'max', '10.0.0.1')
+    >>> failures.isBlocked(1.0, digest, 'max')
+    True
+    >>> failures.isBlocked(1.0, credentialsDigest('max', 'right'), 'max')
+    False
+    >>> failures.isBlocked(3.0, digest, 'max')
+    False
+
+    If a login or a client address fails maxAttempts times, it gets blocked
+    with exponential backoff starting at the timeout:
+
+    >>> failures.failed(4.0, 2.0, 3, None, 'max', '10.0.0.1')
+    >>> failures.failed(5.0, 2.0, 3, None, 'max', None)
+    >>> failures.isBlocked(6.0, login='max')
+    True
+    >>> failures.isBlocked(6.0, address='10.0.0.1')
+    False
+    >>> failures.isBlocked(7.5, login='max')
+    False
+    >>> failures.failed(8.0, 2.0, 3, None, 'max', None)
+    >>> failures.isBlocked(11.5, login='max')
+    True
+    >>> failures.isBlocked(12.5, login='max')
+    False
+
+    The backoff of a login grows up to MAX_LOGIN_BACKOFF seconds only, since
+    anybody knowing the login can let it fail. The backoff of an address
+    grows up to MAX_BACKOFF seconds:
+
+    >>> for i in range(10):
+    ...     failures.failed(100.0, 2.0, 3, None, 'max', '10.0.0.2')
+    >>> failures.isBlocked(100.0 + MAX_LOGIN_BACKOFF, login='max')
+    False
+    >>> failures.isBlocked(100.0 + MAX_LOGIN_BACKOFF, address='10.0.0.2')
+    True
+
+    A successful authentication resets the counter of the login:
+
+    >>> failures.succeeded('max')
+    >>> failures.failed(13.0, 2.0, 3, None, 'max', None)
+    >>> failures.isBlocked(13.5, login='max')
+    False
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # digest -> expiration time
+            self._credentials = collections.OrderedDict()
+            # (kind, value) -> [failures, last failure, blocked until]
+            self._counters = collections.OrderedDict()
+
+    def _isCounterBlocked(self, key, now):
+        entry = self._counters.get(key)
+        if entry is None:
+            return False
+        if now - entry[1] > MAX_BACKOFF:
+            del self._counters[key]
+            return False
+        return entry[2] > now
+
+    def isBlocked(self, now, digest=None, login=None, address=None):
+        """Return True if the credentials, login or address are rejected."""
+        with self._lock:
+            if digest is not None:
+                expires = self._credentials.get(digest)
+                if expires is not None:
+                    if expires > now:
+                        return True
+                    del self._credentials[digest]
+            if login is not None and self._isCounterBlocked(
+                    ('login', login), now):
+                return True
+            return address is not None and self._isCounterBlocked(
+                ('address', address), now)
+
+    def failed(self, now, timeout, maxAttempts, digest=None, login=None,
+               address=None):
+        """Record a failed authentication."""
+        with self._lock:
+            if digest is not None:
+                self._credentials[digest] = now + timeout
+                self._credentials.move_to_end(digest)
+                if len(self._credentials) > MAX_ENTRIES:
+                    self._credentials.popitem(last=False)
+            for key in (('login', login), ('address', address)):
+                if key[1] is None:
+                    continue
+                entry = self._counters.pop(key, None)
+                if entry is None or now - entry[1] > MAX_BACKOFF:
+                    entry = [0, now, 0.0]
+                entry[0] += 1
+                entry[1] = now
+                if entry[0] >= maxAttempts:
+                    exponent = min(entry[0] - maxAttempts, 32)
+                    if key[0] == 'login':
+                        maxBackoff = MAX_LOGIN_BACKOFF
+                    else:
+                        maxBackoff = MAX_BACKOFF
+                    entry[2] = now + min(timeout * 2 ** exponent, maxBackoff)
+                self._counters[key] = entry
+                if len(self._counters) > MAX_ENTRIES:
+                    self._counters.popitem(last=False)
+
+    def succeeded(self, login):
+        """Reset the failure counter of a login."""
+        with self._lock:
+            self._counters.pop(('login', login), None)
+
+
+# failed authentications by authenticator, see getFailedAuthentications
+_failures = VolatileRegistry(FailedAuthentications)
+
+
+def getFailedAuthentications(authenticator):
+    """Return the FailedAuthentications of the given authenticator."""
+    return _failures.get(authenticator)
@@ -13,35 +13,57 @@
 ##############################################################################
 """Users
 """
-import random
-import socket
-import time
-from hashlib import md5
-
+import heapq
+import itertools
+import operator
+import secrets
+import unicodedata
+import zlib
+
+import BTrees.Length
+import BTrees.OOBTree
 import persistent
+import transaction
 import zope.component
 import zope.interface
+import zope.lifecycleevent.interfaces
 from zope.container import btree
 from zope.container import contained
 from zope.container.interfaces import DuplicateIDError
 from zope.password.interfaces import IPasswordManager
 
 from z3c.authenticator import interfaces
+from z3c.authenticator.index import rankResults
+from z3c.authenticator.index import relevance
 
 
-# get the IP address only once
-try:
-    ip = socket.getaddrinfo(socket.gethostname(), 0)[-1][-1][0]
-except BaseException:
-    ip = '127.0.0.1'
+def generateUserIDToken(id):
+    """Generates a unique user id token.
 
+    The token consists of 32 random hex digits like the md5 based tokens of
+    previous versions. The id argument is not used anymore.
+
+    >>> token = generateUserIDToken(u'max')
+    >>> len(token)
+    32
+    >>> token == generateUserIDToken(u'max')
+    False
+    """
+    return secrets.token_hex(16)
 
-def generateUserIDToken(id):
-    """Generates a unique user id token."""
-    t = int(time.time() * 1000)
-    r = int(random.random() * 100000000000000000)
-    data = f"{ip} {t} {r} {id}"
-    return md5(data.encode('utf-8')).hexdigest()
+
+def normalizeLogin(login):
+    """Return the login used for case-insensitive lookups.
+
+    >>> normalizeLogin(u'Max')
+    'max'
+    >>> normalizeLogin(u'STRASSE') == normalizeLogin(u'Stra\xdfe')
+    True
+    >>> normalizeLogin(u'\uff2d\uff41\uff58')
+    'max'
+    """
+    return unicodedata.normalize(
+        'NFKC', unicodedata.normalize('NFKC', login).casefold())
 
 
 @zope.interface.implementer(interfaces.IUser)
@@ -103,9 +125,89 @@ class UserContainer(btree.BTreeContainer):
     See principalfolder.txt for details.
     """
 
-    def __init__(self):
+    # normalized login index, see normalizeLogins
+    _id_by_normalized_login = None
+
+    # attribute indexes by name, see addIndex
+    _indexes = None
+
+    def __init__(self, normalizeLogins=False):
         super().__init__()
         self.__id_by_login = self._newContainerData()
+        self.normalizeLogins = normalizeLogins
+
+    def getNormalizeLogins(self):
+        return self._id_by_normalized_login is not None
+
+    def setNormalizeLogins(self, normalizeLogins):
+        """Enable or disable the case-insensitive login lookup.
+
+        >>> mc = UserContainer()
+        >>> for login in (u'max', u'Max'):
+        ...     user = User(login, u'passwd', login)
+        ...     user.__name__ = login
+        ...     mc[login] = user
+
+        The logins must be unique under normalization:
+
+        >>> mc.normalizeLogins = True
+        Traceback (most recent call last):
+        ...
+        ValueError: Login 'max' is not unique if normalized!
+        >>> mc.normalizeLogins
+        False
+
+        >>> del mc[u'Max']
+        >>> mc.normalizeLogins = True
+        >>> mc.getUserByLogin(u'MAX').title
+        'max'
+
+        >>> user = User(u'MAX', u'passwd', u'MAX')
+        >>> user.__name__ = u'MAX'
+        >>> mc[u'MAX'] = user
+        Traceback (most recent call last):
+        ...
+        zope.container.interfaces.DuplicateIDError: 'Login already taken!'
+
+        >>> user = User(u'moritz', u'passwd', u'moritz')
+        >>> user.__name__ = u'moritz'
+        >>> mc[u'moritz'] = user
+        >>> user.login = u'MAX'
+        Traceback (most recent call last):
+        ...
+        ValueError: Principal Login already taken!
+        >>> user.login = u'Moritz'
+        >>> mc.getUserByLogin(u'MORITZ').login
+        'Moritz'
+
+        If the index drifted, the entry of another user is kept:
+
+        >>> mc._id_by_normalized_login[u'moritz'] = u'max'
+        >>> user.login = u'Fritz'
+        >>> mc.getUserByLogin(u'FRITZ').login
+        'Fritz'
+        >>> mc._id_by_normalized_login[u'moritz']
+        'max'
+        """
+        if not normalizeLogins:
+            self._id_by_normalized_login = None
+        elif self._id_by_normalized_login is None:
+            index = self._newContainerData()
+            for login, id in self.__id_by_login.items():
+                key = normalizeLogin(login)
+                if key in index:
+                    raise ValueError(
+                        'Login %r is not unique if normalized!' % login)
+                index[key] = id
+            self._id_by_normalized_login = index
+
+    normalizeLogins = property(getNormalizeLogins, setNormalizeLogins)
+
+    def _queryIdByLogin(self, login):
+        id = self.__id_by_login.get(login)
+        if id is None and self._id_by_normalized_login is not None:
+            id = self._id_by_normalized_login.get(normalizeLogin(login))
+        return id
 
     def notifyLoginChanged(self, oldLogin, principal):
         """Notify the Container about changed login of a principal.
@@ -116,8 +218,20 @@ class UserContainer(btree.BTreeContainer):
         if principal.login in self.__id_by_login:
             raise ValueError('Principal Login already taken!')
 
+        normalized = self._id_by_normalized_login
+        if normalized is not None:
+            key = normalizeLogin(principal.login)
+            if normalized.get(key, principal.__name__) != principal.__name__:
+                raise ValueError('Principal Login already taken!')
+            oldKey = normalizeLogin(oldLogin)
+            # don't drop the entry of another user if the index drifted
+            if normalized.get(oldKey) == principal.__name__:
+                del normalized[oldKey]
+            normalized[key] = principal.__name__
+
         del self.__id_by_login[oldLogin]
         self.__id_by_login[principal.login] = principal.__name__
+        self.reindex(principal)
 
     def __setitem__(self, id, user):
         """Add a IPrincipal object within a correct id.
@@ -202,8 +316,17 @@ class UserContainer(btree.BTreeContainer):
         if user.login in self.__id_by_login:
             raise DuplicateIDError('Login already taken!')
 
+        normalized = self._id_by_normalized_login
+        if normalized is not None:
+            key = normalizeLogin(user.login)
+            if key in normalized:
+                raise DuplicateIDError('Login already taken!')
+
         super().__setitem__(id, user)
         self.__id_by_login[user.login] = id
+        if normalized is not None:
+            normalized[key] = id
+        self.reindex(user)
 
     def add(self, user):
         token = generateUserIDToken(user.login)
@@ -217,6 +340,13 @@ class UserContainer(btree.BTreeContainer):
         user = self[id]
         super().__delitem__(id)
         del self.__id_by_login[user.login]
+        normalized = self._id_by_normalized_login
+        if normalized is not None:
+            key = normalizeLogin(user.login)
+            if normalized.get(key) == id:
+                del normalized[key]
+        for index in (self._indexes or {}).values():
+            index.unindex(id)
 
     def authenticateCredentials(self, credentials):
         """Return principal if credentials can be authenticated
@@ -225,7 +355,7 @@ class UserContainer(btree.BTreeContainer):
             return None
         if not ('login' in credentials and 'password' in credentials):
             return None
-        id = self.__id_by_login.get(credentials['login'])
+        id = self._queryIdByLogin(credentials['login'])
         if id is None:
             return None
         user = self[id]
@@ -235,7 +365,155 @@ class UserContainer(btree.BTreeContainer):
 
     def getUserByLogin(self, login):
         # don't bother catching KeyError, it's the task of the caller
-        return self[self.__id_by_login[login]]
+        id = self._queryIdByLogin(login)
+        if id is None:
+            raise KeyError(login)
+        return self[id]
+
+    def verifyLoginIndex(self, repair=False, cursor=None, chunkSize=1000,
+                         chunks=None):
+        """Verify and optionally rebuild the login index.
+
+        The users get scanned in id order, followed by the index entries in
+        login order. A savepoint gets created after each chunk of chunkSize
+        items. If chunks is given, the verification stops after this number
+        of chunks and returns a cursor which allows to resume it later:
+
+        >>> mc = UserContainer()
+        >>> for login in (u'max', u'moritz', u'witwe'):
+        ...     user = User(login, u'passwd', login.title())
+        ...     user.__name__ = login
+        ...     mc[login] = user
+
+        >>> report = mc.verifyLoginIndex()
+        >>> report['checked'], report['drift'], report['cursor']
+        (6, 0, None)
+
+        Let's break the index:
+
+        >>> index = mc._UserContainer__id_by_login
+        >>> del index[u'max']
+        >>> index[u'moritz'] = u'witwe'
+        >>> index[u'bolte'] = u'bolte'
+
+        >>> report = mc.verifyLoginIndex(repair=True, chunkSize=2, chunks=1)
+        >>> report['checked'], report['drift'], report['cursor']
+        (2, 2, ('users', 'moritz'))
+
+        >>> report = mc.verifyLoginIndex(repair=True, cursor=report['cursor'],
+        ...                              chunkSize=2)
+        >>> report['checked'], report['drift'], report['stale']
+        (5, 1, 1)
+        >>> report['cursor'] is None
+        True
+
+        >>> sorted(index.items())
+        [('max', 'max'), ('moritz', 'moritz'), ('witwe', 'witwe')]
+
+        A missing index gets created:
+
+        >>> del mc._UserContainer__id_by_login
+        >>> report = mc.verifyLoginIndex(repair=True)
+        >>> report['missing'], report['repaired']
+        (3, True)
+        >>> mc.getUserByLogin(u'max').title
+        'Max'
+
+        The normalized login index gets verified too:
+
+        >>> mc.normalizeLogins = True
+        >>> normalized = mc._id_by_normalized_login
+        >>> normalized[u'bolte'] = u'bolte'
+        >>> del normalized[u'max']
+        >>> report = mc.verifyLoginIndex(repair=True)
+        >>> report['checked'], report['missing'], report['stale']
+        (10, 1, 1)
+        >>> sorted(normalized.items())
+        [('max', 'max'), ('moritz', 'moritz'), ('witwe', 'witwe')]
+        """
+        index = getattr(self, '_UserContainer__id_by_login', None)
+        if index is None:
+            index = self._newContainerData()
+            if repair:
+                self.__id_by_login = index
+        indexes = {'logins': (index, str)}
+        if self._id_by_normalized_login is not None:
+            indexes['normalized'] = (self._id_by_normalized_login,
+                                     normalizeLogin)
+        phases = ['users'] + list(indexes)
+        report = {'checked': 0, 'missing': 0, 'wrong': 0, 'stale': 0,
+                  'duplicates': 0}
+        phase, key = cursor or ('users', None)
+        done = 0
+        while chunks is None or done < chunks:
+            if phase == 'users':
+                tree = self._SampleContainer__data
+            else:
+                tree, normalize = indexes[phase]
+            chunk = list(itertools.islice(
+                tree.items(min=key, excludemin=key is not None), chunkSize))
+            if not chunk:
+                position = phases.index(phase) + 1
+                if position == len(phases):
+                    key = None
+                    break
+                phase, key = phases[position], None
+                continue
+            for name, value in chunk:
+                if phase == 'users':
+                    for tree, normalize in indexes.values():
+                        self._verifyLogin(tree, normalize, name, value,
+                                          repair, report)
+                else:
+                    user = self.get(value)
+                    if user is None or normalize(user.login) != name:
+                        report['stale'] += 1
+                        if repair:
+                            del tree[name]
+            report['checked'] += len(chunk)
+            key = chunk[-1][0]
+            done += 1
+            transaction.savepoint(optimistic=True)
+        report['drift'] = (report['missing'] + report['wrong'] +
+                           report['stale'])
+        report['repaired'] = bool(repair and report['drift'])
+        report['cursor'] = None if key is None else (phase, key)
+        return report
+
+    def _verifyLogin(self, index, normalize, id, user, repair, report):
+        login = normalize(user.login)
+        current = index.get(login)
+        if current == id:
+            return
+        if current is None:
+            report['missing'] += 1
+        else:
+            other = self.get(current)
+            if other is not None and normalize(other.login) == login:
+                # two users share the login, we can't decide
+                report['duplicates'] += 1
+                return
+            report['wrong'] += 1
+        if repair:
+            index[login] = id
+
+    def addIndex(self, name, index):
+        if name in ('search', 'sort'):
+            raise ValueError('The name %s is reserved!' % name)
+        if self._indexes is None:
+            self._indexes = BTrees.OOBTree.OOBTree()
+        index.clear()
+        for id, user in self.items():
+            index.index(id, user)
+        self._indexes[name] = index
+
+    def removeIndex(self, name):
+        del self._indexes[name]
+
+    def reindex(self, user):
+        if self._indexes:
+            for index in self._indexes.values():
+                index.index(user.__name__, user)
 
     def queryPrincipal(self, id, default=None):
         user = self.get(id)
@@ -243,18 +521,313 @@ class UserContainer(btree.BTreeContainer):
             return user
         return default
 
+    def queryPrincipals(self, ids):
+        users = {}
+        for id in ids:
+            user = self.get(id)
+            if user is not None:
+                users[id] = user
+        return users
+
     def search(self, query, start=None, batch_size=None):
-        """Search through this principal provider."""
+        """Search through this principal provider.
+
+        Besides the substring search, the query can contain values for the
+        indexes added with addIndex:
+
+        >>> from z3c.authenticator.index import FieldIndex
+        >>> mc = UserContainer()
+        >>> mc.addIndex(u'email', FieldIndex('email'))
+        >>> for login in (u'max', u'moritz', u'witwe'):
+        ...     user = User(login, u'passwd', login.title())
+        ...     user.email = u'%s@example.com' % login
+        ...     user.__name__ = login
+        ...     mc[login] = user
+
+        >>> list(mc.search({'email': u'moritz@example.com'}))
+        ['moritz']
+
+        The names of the search parameters can't get used:
+
+        >>> mc.addIndex(u'sort', FieldIndex('email'))
+        Traceback (most recent call last):
+        ...
+        ValueError: The name sort is reserved!
+        >>> list(mc.search({'email': [u'max@example.com',
+        ...                           u'witwe@example.com']}))
+        ['max', 'witwe']
+        >>> list(mc.search({'email': [u'max@example.com',
+        ...                           u'witwe@example.com'],
+        ...                 'search': u'wit'}))
+        ['witwe']
+
+        The indexes get updated if a user gets modified and the reindexUser
+        subscriber is registered:
+
+        >>> import zope.event
+        >>> import zope.lifecycleevent
+        >>> zope.component.provideHandler(reindexUser)
+        >>> mc[u'max'].email = u'max@example.org'
+        >>> zope.event.notify(zope.lifecycleevent.ObjectModifiedEvent(
+        ...     mc[u'max']))
+        >>> list(mc.search({'email': u'max@example.org'}))
+        ['max']
+
+        >>> del mc[u'max']
+        >>> list(mc.search({'email': u'max@example.org'}))
+        []
+
+        With ``sort`` set to ``relevance`` the results get ranked. Exact
+        login matches come first, then login and title prefixes, title
+        words, other substrings and descriptions:
+
+        >>> for login, title in ((u'hamax', u'Hamax'),
+        ...                      (u'maxine', u'Maxine'),
+        ...                      (u'mm', u'Moritz Max'),
+        ...                      (u'max', u'Max')):
+        ...     user = User(login, u'passwd', title)
+        ...     user.__name__ = login
+        ...     mc[login] = user
+        >>> list(mc.search({'search': u'max'}))
+        ['hamax', 'max', 'maxine', 'mm']
+        >>> list(mc.search({'search': u'max', 'sort': 'relevance'}))
+        ['max', 'maxine', 'mm', 'hamax']
+        >>> list(mc.search({'search': u'max', 'sort': 'relevance'},
+        ...                start=1, batch_size=2))
+        ['maxine', 'mm']
+        """
         search = query.get('search')
-        if search is None:
+        indexes = self._indexes or {}
+        result = None
+        for name, value in query.items():
+            index = indexes.get(name)
+            if index is not None:
+                ids = index.apply(value)
+                if result is None:
+                    result = ids
+                else:
+                    result = BTrees.OOBTree.intersection(result, ids)
+        if result is None:
+            if search is None:
+                return
+            users = self.values()
+        else:
+            users = (self[id] for id in result)
+        if search is not None and query.get('sort') == 'relevance':
+            yield from rankResults(
+                ((relevance(search, value.title, value.login,
+                            value.description),
+                  value.title.lower(), value.__name__) for value in users),
+                start, batch_size)
             return
-        search = search.lower()
-        n = 1
-        for i, value in enumerate(self.values()):
-            if (search in value.title.lower() or
-                search in value.description.lower() or
-                    search in value.login.lower()):
-                if not ((start is not None and i < start)
-                        or (batch_size is not None and n > batch_size)):
-                    n += 1
-                    yield value.__name__
+        if search is not None:
+            search = search.lower()
+        found = (value.__name__ for value in users
+                 if (search is None or
+                     search in value.title.lower() or
+                     search in value.description.lower() or
+                     search in value.login.lower()))
+        # once the batch is complete the others don't get scanned
+        start = start or 0
+        stop = None if batch_size is None else start + batch_size
+        yield from itertools.islice(found, start, stop)
+
+
+def shardKey(key, shards):
+    """Return the stable shard number of the given key."""
+    return zlib.crc32(key.encode('utf-8')) % shards
+
+
+class ShardedSequence:
+    """Lazy sequence merging the sorted sequences of several BTrees.
+
+    Like the sequences returned by the BTrees, it supports len, indexing,
+    slicing and iterating more than once without loading all items:
+
+    >>> a = BTrees.OOBTree.OOBTree({u'a': 1, u'c': 3})
+    >>> b = BTrees.OOBTree.OOBTree({u'b': 2, u'd': 4})
+    >>> keys = ShardedSequence([a.keys(), b.keys()])
+    >>> len(keys), keys[1], keys[-1], keys[1:3]
+    (4, 'b', 'd', ['b', 'c'])
+    >>> list(keys), list(keys)
+    (['a', 'b', 'c', 'd'], ['a', 'b', 'c', 'd'])
+
+    >>> values = ShardedSequence([a.items(), b.items()],
+    ...                          key=operator.itemgetter(0),
+    ...                          select=operator.itemgetter(1))
+    >>> list(values), values[0], values[::-2]
+    ([1, 2, 3, 4], 1, [4, 2])
+    >>> values[4]
+    Traceback (most recent call last):
+    ...
+    IndexError: 4
+    """
+
+    def __init__(self, sequences, key=None, select=None):
+        self._sequences = sequences
+        self._key = key
+        self._select = select
+
+    def __len__(self):
+        return sum(len(sequence) for sequence in self._sequences)
+
+    def __iter__(self):
+        merged = heapq.merge(*self._sequences, key=self._key)
+        if self._select is None:
+            return merged
+        return map(self._select, merged)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step < 0:
+                return list(self)[index]
+            return list(itertools.islice(self, start, stop, step))
+        if index < 0:
+            index += len(self)
+        if index >= 0:
+            for item in itertools.islice(self, index, None):
+                return item
+        raise IndexError(index)
+
+
+class ShardedTree(persistent.Persistent):
+    """Mapping spreading its items over several OOBTrees by key hash.
+
+    The trees get created once, so the mapping itself never changes and
+    concurrent changes only touch the tree of their shard. The number of
+    items is kept in a BTrees.Length which resolves concurrent changes:
+
+    >>> tree = ShardedTree(4)
+    >>> for key in (u'c', u'a', u'd', u'b'):
+    ...     tree[key] = key.upper()
+    >>> tree[u'a'] = u'A'
+    >>> len(tree)
+    4
+    >>> tree[u'a'], tree.get(u'x'), u'b' in tree
+    ('A', None, True)
+
+    The keys, values and items are lazy sequences merging the shards in key
+    order:
+
+    >>> items = tree.items()
+    >>> list(items)
+    [('a', 'A'), ('b', 'B'), ('c', 'C'), ('d', 'D')]
+    >>> len(items), items[1], items[-1]
+    (4, ('b', 'B'), ('d', 'D'))
+    >>> list(tree.keys(u'b'))
+    ['b', 'c', 'd']
+    >>> tree.values(u'b')[:2]
+    ['B', 'C']
+    >>> list(tree.items(min=u'b', excludemin=True))
+    [('c', 'C'), ('d', 'D')]
+
+    >>> del tree[u'a']
+    >>> list(tree), len(tree)
+    (['b', 'c', 'd'], 3)
+    """
+
+    def __init__(self, shards):
+        self._trees = tuple([BTrees.OOBTree.OOBTree() for i in range(shards)])
+        self._length = BTrees.Length.Length()
+
+    def _tree(self, key):
+        return self._trees[shardKey(key, len(self._trees))]
+
+    def __getitem__(self, key):
+        return self._tree(key)[key]
+
+    def get(self, key, default=None):
+        return self._tree(key).get(key, default)
+
+    def __setitem__(self, key, value):
+        tree = self._tree(key)
+        if tree.insert(key, value):
+            self._length.change(1)
+        else:
+            tree[key] = value
+
+    def __delitem__(self, key):
+        del self._tree(key)[key]
+        self._length.change(-1)
+
+    def __contains__(self, key):
+        return key in self._tree(key)
+
+    has_key = __contains__
+
+    def __len__(self):
+        return self._length()
+
+    def items(self, min=None, max=None, excludemin=False, excludemax=False):
+        return ShardedSequence(
+            [tree.items(min, max, excludemin, excludemax)
+             for tree in self._trees],
+            key=operator.itemgetter(0))
+
+    def keys(self, min=None, max=None, excludemin=False, excludemax=False):
+        return ShardedSequence(
+            [tree.keys(min, max, excludemin, excludemax)
+             for tree in self._trees])
+
+    def values(self, min=None, max=None, excludemin=False, excludemax=False):
+        return ShardedSequence(
+            [tree.items(min, max, excludemin, excludemax)
+             for tree in self._trees],
+            key=operator.itemgetter(0), select=operator.itemgetter(1))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+@zope.interface.implementer(interfaces.IShardedUserContainer)
+class ShardedUserContainer(UserContainer):
+    """User container spreading its users over several BTrees.
+
+    The users get stored by the hash of their id and the login index entries
+    by the hash of the login. This avoids conflicts in the root buckets of
+    the BTrees if users get added concurrently:
+
+    >>> mc = ShardedUserContainer(shards=4)
+    >>> mc.shards
+    4
+    >>> for login in (u'max', u'moritz', u'witwe'):
+    ...     user = User(login, u'passwd', login.title())
+    ...     user.__name__ = login
+    ...     mc[login] = user
+
+    >>> len(mc)
+    3
+    >>> list(mc.keys())
+    ['max', 'moritz', 'witwe']
+    >>> mc.getUserByLogin(u'moritz').title
+    'Moritz'
+    >>> mc.queryPrincipal(u'witwe').title
+    'Witwe'
+    >>> list(mc.search({'search': u'wit'}))
+    ['witwe']
+
+    >>> del mc[u'max']
+    >>> u'max' in mc._SampleContainer__data._trees[shardKey(u'max', 4)]
+    False
+    >>> len(mc)
+    2
+    >>> mc.verifyLoginIndex()['drift']
+    0
+    """
+
+    def __init__(self, shards=16, normalizeLogins=False):
+        self.shards = shards
+        super().__init__(normalizeLogins)
+
+    def _newContainerData(self):
+        return ShardedTree(self.shards)
+
+
+@zope.component.adapter(interfaces.IUser,
+                        zope.lifecycleevent.interfaces.IObjectModifiedEvent)
+def reindexUser(user, event):
+    """Update the indexes of the user container if a user gets modified."""
+    parent = user.__parent__
+    if interfaces.IUserContainer.providedBy(parent):
+        parent.reindex(user)
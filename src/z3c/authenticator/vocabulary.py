@@ -15,11 +15,15 @@
 """
 
 import base64
+import functools
+import threading
 
+import BTrees.Length
 import zope.component
 import zope.dublincore.interfaces
 import zope.i18n
 import zope.interface
+from zope.container.interfaces import IContainerModifiedEvent
 from zope.schema import vocabulary
 from zope.schema.interfaces import IVocabularyFactory
 
@@ -38,6 +42,75 @@ MISSING_TITLE = _(
     '${name} (not found; deselecting will remove)')
 
 
+# changed by registration events, see _pluginVocabulary
+_generation = 0
+_generationLock = threading.Lock()
+
+
+def invalidateVocabularies(*args):
+    """Drop the cached plugin vocabularies.
+
+    This is a subscriber for registration events.
+    """
+    global _generation
+    with _generationLock:
+        _generation += 1
+
+
+def bumpPluginsVersion(auth):
+    """Note a change of the plugins contained in an authenticator.
+
+    The version is a BTrees.Length.Length, concurrent changes get merged on
+    conflicts. Authenticators without a version only drop the vocabularies
+    cached by this process.
+    """
+    if not interfaces.IAuthenticator.providedBy(auth):
+        invalidateVocabularies()
+        return
+    version = getattr(auth, '_pluginsVersion', None)
+    if version is None:
+        # authenticator created before the version got introduced
+        version = auth._pluginsVersion = BTrees.Length.Length()
+    version.change(1)
+
+
+def pluginsVersion(auth):
+    """Return the version of the plugins contained in an authenticator.
+
+    It is None while the version has uncommitted changes.
+    """
+    version = getattr(auth, '_pluginsVersion', None)
+    if version is None:
+        return (_generation, 0)
+    value = version()
+    if version._p_changed:
+        return None
+    return (_generation, value)
+
+
+def pluginModified(plugin, event):
+    """Subscriber for modified plugins, e.g. for a changed title.
+
+    The title may be stored outside of the plugin, in its annotations, so
+    the version of the authenticator gets bumped and the vocabularies cached
+    by other connections get rebuilt after the commit. The transaction
+    modifies the plugin anyway and the version resolves conflicts, so this
+    doesn't add a conflict point. Modified containers, e.g. a user container
+    with a new user, get ignored.
+    """
+    if IContainerModifiedEvent.providedBy(event):
+        return
+    bumpPluginsVersion(getattr(plugin, '__parent__', None))
+
+
+def pluginMoved(plugin, event):
+    """Subscriber for plugins added to or removed from an authenticator."""
+    for parent in (event.oldParent, event.newParent):
+        if interfaces.IAuthenticator.providedBy(parent):
+            bumpPluginsVersion(parent)
+
+
+@functools.lru_cache(maxsize=1024)
 def mktok(s):
     tok = base64.encodebytes(s.encode('utf-8')).decode('utf-8')
     return tok.strip()
@@ -60,7 +133,33 @@ def _pluginVocabulary(context, interface, attr_name):
     The vocabulary also includes the current values of the
     Authenticator even if they do not correspond to a contained or
     utility plugin.
+
+    The vocabularies of an Authenticator get cached per connection until
+    the version of its plugins, the contained or selected names or the names
+    of the utility plugins change or invalidateVocabularies gets called.
+    Nothing gets cached while the version has uncommitted changes.
     """
+    auth = interfaces.IAuthenticator.providedBy(context)
+    utils = list(zope.component.getUtilitiesFor(interface, context))
+    if not auth:
+        return _buildPluginVocabulary(context, interface, attr_name, utils)
+
+    version = pluginsVersion(context)
+    key = (version, tuple(context.keys()), tuple(getattr(context, attr_name)),
+           tuple([nm for nm, util in utils]))
+    cache = getattr(context, '_v_pluginVocabularies', None)
+    if cache is None:
+        cache = context._v_pluginVocabularies = {}
+    cached = cache.get((interface, attr_name))
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    vocab = _buildPluginVocabulary(context, interface, attr_name, utils)
+    if version is not None:
+        cache[(interface, attr_name)] = (key, vocab)
+    return vocab
+
+
+def _buildPluginVocabulary(context, interface, attr_name, utils):
     terms = {}
     auth = interfaces.IAuthenticator.providedBy(context)
     if auth:
@@ -75,7 +174,6 @@ def _pluginVocabulary(context, interface, attr_name):
                 terms[k] = vocabulary.SimpleTerm(
                     k, mktok(k), zope.i18n.Message(
                         CONTAINED_TITLE, mapping={'name': title}))
-    utils = zope.component.getUtilitiesFor(interface, context)
     for nm, util in utils:
         if nm not in terms:
             terms[nm] = vocabulary.SimpleTerm(
@@ -105,3 +203,14 @@ def credentialsPlugins(context):
 
 
 zope.interface.alsoProvides(credentialsPlugins, IVocabularyFactory)
+
+
+# Register our cleanup with Testing.CleanUp to make writing unit tests
+# simpler.
+try:
+    from zope.testing.cleanup import addCleanUp
+except ModuleNotFoundError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(invalidateVocabularies)
+    del addCleanUp
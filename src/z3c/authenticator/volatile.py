@@ -0,0 +1,139 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Values kept in memory per authenticator
+"""
+import collections
+import threading
+import weakref
+
+
+# all registries, see _clear
+_registries = weakref.WeakSet()
+
+
+def authenticatorKey(authenticator):
+    """Return the key of a stored authenticator or None.
+
+    The key is the same for the copies of the authenticator in all
+    connections of a database:
+
+    >>> from ZODB.DB import DB
+    >>> from z3c.authenticator.authentication import Authenticator
+    >>> db = DB(None, database_name='main')
+    >>> conn = db.open()
+    >>> auth = conn.root()['auth'] = Authenticator()
+    >>> authenticatorKey(auth) is None
+    True
+
+    >>> import transaction
+    >>> transaction.commit()
+    >>> authenticatorKey(auth)
+    ('main', b'\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x01')
+
+    >>> conn.close()
+    >>> db.close()
+    """
+    oid = getattr(authenticator, '_p_oid', None)
+    jar = getattr(authenticator, '_p_jar', None)
+    if oid is None or jar is None:
+        return None
+    return (jar.db().database_name, oid)
+
+
+class VolatileRegistry:
+    """Values created by factory and kept in memory per authenticator.
+
+    The value of a stored authenticator is shared by all connections and
+    threads. At most maxSize values of stored authenticators are kept, the
+    least recently used get dropped first:
+
+    >>> registry = VolatileRegistry(list, maxSize=2)
+
+    The values of authenticators not stored yet are kept as long as the
+    authenticator lives:
+
+    >>> from z3c.authenticator.authentication import Authenticator
+    >>> auth = Authenticator()
+    >>> registry.get(auth).append('failure')
+    >>> registry.get(auth)
+    ['failure']
+    >>> registry.get(Authenticator())
+    []
+
+    >>> len(registry._unstored)
+    1
+    >>> del auth
+    >>> len(registry._unstored)
+    0
+    """
+
+    def __init__(self, factory, maxSize=1000):
+        self.factory = factory
+        self.maxSize = maxSize
+        self._lock = threading.Lock()
+        self.clear()
+        _registries.add(self)
+
+    def clear(self):
+        with self._lock:
+            # (database name, oid) -> value
+            self._stored = collections.OrderedDict()
+            # id -> (weak reference, value)
+            self._unstored = {}
+
+    def get(self, authenticator):
+        """Return the value of the authenticator, create it if needed."""
+        key = authenticatorKey(authenticator)
+        if key is None:
+            return self._getUnstored(authenticator)
+        with self._lock:
+            value = self._stored.get(key)
+            if value is None:
+                value = self._stored[key] = self.factory()
+                if len(self._stored) > self.maxSize:
+                    self._stored.popitem(last=False)
+            else:
+                self._stored.move_to_end(key)
+        return value
+
+    def _getUnstored(self, authenticator):
+        ident = id(authenticator)
+        with self._lock:
+            entry = self._unstored.get(ident)
+            if entry is not None and entry[0]() is authenticator:
+                return entry[1]
+            value = self.factory()
+            # forget the value before the id can get reused, no lock here
+            # since the callback might run in get
+            unstored = self._unstored
+            ref = weakref.ref(
+                authenticator, lambda ref: unstored.pop(ident, None))
+            self._unstored[ident] = (ref, value)
+        return value
+
+
+def _clear():
+    for registry in list(_registries):
+        registry.clear()
+
+
+# Register our cleanup with Testing.CleanUp to make writing unit tests
+# simpler.
+try:
+    from zope.testing.cleanup import addCleanUp
+except ModuleNotFoundError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(_clear)
+    del addCleanUp
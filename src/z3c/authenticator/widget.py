@@ -13,6 +13,9 @@
 ##############################################################################
 """Principal Source Widget Implementation
 """
+import base64
+import binascii
+
 import zope.component
 import zope.i18n
 import zope.interface
@@ -34,14 +37,21 @@ from z3c.formui import form
 from z3c.template.template import getLayoutTemplate
 from zope.authentication.interfaces import IAuthentication
 from zope.authentication.interfaces import IPrincipalSource
+from zope.authentication.interfaces import PrincipalLookupError
+from zope.authentication.principal import PrincipalSource
+from zope.principalregistry.principalregistry import principalRegistry
 from zope.traversing import api
 
 from z3c.authenticator import interfaces
+from z3c.authenticator.principalregistry import getRegistryIndex
 
 
 class IPrincipalSourceWidget(IFieldWidget):
     """SourceWidget."""
 
+    batchSize = zope.interface.Attribute(
+        "Number of selected principals rendered per page.")
+
     def addValue(value):
         """Add and render value as sequence item."""
 
@@ -57,6 +67,31 @@ class ISourceSearchForm(zope.interface.Interface):
     """Search schema."""
 
 
+# request annotation key of the terms cache, see PrincipalTerms
+TERMS_CACHE_KEY = 'z3c.authenticator.widget.PrincipalTerms'
+
+
+def toToken(value):
+    """Return the token of a principal id.
+
+    >>> toToken(u'zope.mgr')
+    'em9wZS5tZ3I'
+    >>> fromToken(toToken(u'zope.mgr'))
+    'zope.mgr'
+    """
+    token = base64.urlsafe_b64encode(value.encode('utf-8'))
+    return token.decode('ascii').rstrip('=')
+
+
+def fromToken(token):
+    """Return the principal id of a token."""
+    try:
+        value = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        return value.decode('utf-8')
+    except (binascii.Error, UnicodeError, ValueError):
+        raise LookupError(token)
+
+
 # TODO: remove this if we have a fixed version of z3c.form
 class PrincipalSourceDataConverter(converter.CollectionSequenceDataConverter):
     """A special converter between collections and sequence widgets."""
@@ -67,7 +102,17 @@ class PrincipalSourceDataConverter(converter.CollectionSequenceDataConverter):
         widget = self.widget
         if widget.terms is None:
             widget.updateTerms()
-        return [widget.terms.getTerm(entry).token for entry in value]
+        getTerms = getattr(widget.terms, 'getTerms', None)
+        if getTerms is None:
+            return [widget.terms.getTerm(entry).token for entry in value]
+        tokens = [term.token for term in getTerms(value)]
+        if len(tokens) != len(value):
+            # getTerms skips unknown principals, getTerm doesn't
+            found = set(tokens)
+            for entry in value:
+                if toToken(entry) not in found:
+                    raise LookupError(entry)
+        return tokens
 
     def toFieldValue(self, value):
         widget = self.widget
@@ -107,6 +152,21 @@ class SourceSearchDataConverter(converter.CollectionSequenceDataConverter):
                                for token in value])
 
 
+def addTermItem(widget, term):
+    """Append the sequence item of the term to the widget items once."""
+    if term.token in widget._itemTokens:
+        return
+    widget._itemTokens.add(term.token)
+    label = zope.i18n.translate(term.title, context=widget.request,
+                                default=term.title)
+    widget.items.append({
+        'id': f'{widget.id}-{term.token}',
+        'name': widget.name + ':list',
+        'value': term.token,
+        'label': label,
+        'checked': widget.isChecked(term)})
+
+
 class PrincipalTerm:
 
     def __init__(self, token, title):
@@ -131,25 +191,61 @@ class PrincipalTerms:
         self.widget = widget
         self.source = field.value_type.bind(self.context).vocabulary
 
-    def getTerm(self, pid):
-        if pid not in self.source:
-            raise LookupError(pid)
+    def _cache(self):
+        # the terms by principal id get shared by all widgets and search
+        # forms of the request
+        annotations = getattr(self.request, 'annotations', None)
+        if annotations is None:
+            annotations = self.__dict__.setdefault('_annotations', {})
+        return annotations.setdefault(TERMS_CACHE_KEY, {})
 
+    def _lookupTerms(self, pids):
         auth = zope.component.getUtility(IAuthentication)
-        principal = auth.getPrincipal(pid)
+        if interfaces.IAuthenticator.providedBy(auth):
+            principals = auth.queryPrincipals(pids)
+        else:
+            principals = {}
+            for pid in pids:
+                try:
+                    principals[pid] = auth.getPrincipal(pid)
+                except PrincipalLookupError:
+                    pass
+        terms = {}
+        for pid in pids:
+            principal = principals.get(pid)
+            if principal is not None:
+                terms[pid] = PrincipalTerm(toToken(pid), principal.title)
+            else:
+                terms[pid] = None
+        return terms
+
+    def getTerms(self, pids):
+        """Return the terms of the given principal ids.
+
+        The principals get looked up at once, unknown principals are
+        skipped.
+        """
+        pids = list(pids)
+        if not isinstance(self.source, PrincipalSource):
+            # a PrincipalSource contains all principals found by the lookup
+            pids = [pid for pid in pids if pid in self.source]
+        cache = self._cache()
+        missing = [pid for pid in dict.fromkeys(pids) if pid not in cache]
+        if missing:
+            cache.update(self._lookupTerms(missing))
+        return [cache[pid] for pid in pids if cache[pid] is not None]
 
-        if principal is None:
+    def getTerm(self, pid):
+        terms = self.getTerms([pid])
+        if not terms:
             raise LookupError(pid)
-
-        return PrincipalTerm(pid.encode('base64').strip().replace('=', '_'),
-                             principal.title)
+        return terms[0]
 
     def getTermByToken(self, token):
-        pid = token.replace('_', '=').decode('base64')
-        return self.getTerm(pid)
+        return self.getTerm(fromToken(token))
 
     def getValue(self, token):
-        return token.replace('_', '=').decode('base64')
+        return fromToken(token)
 
     def __contains__(self, pid):
         if pid in self.source:
@@ -188,27 +284,24 @@ class SourceResultWidget(widget.HTMLInputWidget, SequenceWidget):
         return term.token in self.value
 
     def addValue(self, value):
-        term = self.terms.getTerm(value)
-        checked = self.isChecked(term)
-        label = zope.i18n.translate(term.title, context=self.request,
-                                    default=term.title)
-        id = f'{self.id}-{term.token}'
-        item = {'id': id, 'name': self.name + ':list', 'value': term.token,
-                'label': label, 'checked': checked}
-        if item not in self.items:
-            self.items.append(item)
+        addTermItem(self, self.terms.getTerm(value))
 
     def updateTerms(self):
         self.terms = self.form.terms
         return self.terms
 
+    def getTerms(self, values):
+        getTerms = getattr(self.terms, 'getTerms', None)
+        if getTerms is not None:
+            return getTerms(values)
+        return [self.terms.getTerm(value) for value in values]
+
     def extract(self, default=[]):
         """See z3c.form.interfaces.IWidget."""
         tokens = super().extract(default)
-        for value in self.searchResults:
-            token = self.terms.getTerm(value).token
-            if token not in tokens:
-                tokens.append(token)
+        for term in self.getTerms(self.searchResults):
+            if term.token not in tokens:
+                tokens.append(term.token)
         return tokens
 
     def update(self):
@@ -218,11 +311,12 @@ class SourceResultWidget(widget.HTMLInputWidget, SequenceWidget):
 
         # update search forms
         self.items = []
+        self._itemTokens = set()
 
         # append existing items
-        for token in self.value:
-            value = self.terms.getValue(token)
-            self.addValue(value)
+        values = [self.terms.getValue(token) for token in self.value]
+        for term in self.getTerms(values):
+            addTermItem(self, term)
 
 
 def getSourceResultWidget(field, request):
@@ -345,10 +439,14 @@ class PrincipalRegistrySearchForm(SearchFormMixin):
 
     def search(self, data):
         # avoid empty search strings
+        value = []
         if data.get('search'):
             searchStr = data.get('search')
-            value = [principal.id
-                     for principal in self.context.getPrincipals(searchStr)]
+            if self.context is principalRegistry:
+                value = list(getRegistryIndex().search(searchStr))
+            else:
+                value = [principal.id for principal in
+                         self.context.getPrincipals(searchStr)]
         return value
 
 
@@ -361,6 +459,9 @@ class PrincipalSourceWidget(widget.HTMLInputWidget, SequenceWidget):
     klass = 'principal-source-widget checkbox-widget'
     value = []
     items = []
+    hiddenTokens = []
+    pages = []
+    batchSize = 50
 
     def __init__(self, field, source, request):
         self.field = field
@@ -368,32 +469,54 @@ class PrincipalSourceWidget(widget.HTMLInputWidget, SequenceWidget):
         self.request = request
 
     def isChecked(self, term):
-        return term.token in self.value
+        return term.token in self._checked
 
     def addValue(self, value):
-        term = self.terms.getTerm(value)
-        checked = self.isChecked(term)
-        label = zope.i18n.translate(term.title, context=self.request,
-                                    default=term.title)
-        id = f'{self.id}-{term.token}'
-        item = {'id': id, 'name': self.name + ':list', 'value': term.token,
-                'label': label, 'checked': checked}
-        if item not in self.items:
-            self.items.append(item)
+        addTermItem(self, self.terms.getTerm(value))
+
+    @property
+    def pageName(self):
+        return self.name + '-page'
+
+    def getTerms(self, values):
+        getTerms = getattr(self.terms, 'getTerms', None)
+        if getTerms is not None:
+            return getTerms(values)
+        return [self.terms.getTerm(value) for value in values]
 
     def update(self):
         """See z3c.form.interfaces.IWidget."""
         super().update()
         widget.addFieldClass(self)
 
+        tokens = list(dict.fromkeys(self.value))
+        self._checked = set(tokens)
+
         # update serach forms
         self.items = []
+        self._itemTokens = set()
         self.updateSearchForms()
 
-        # append existing items
-        for token in self.value:
-            value = self.terms.getValue(token)
-            self.addValue(value)
+        # render the selected principals of the current page only, the
+        # others get kept as hidden inputs
+        count = max(1, -(-len(tokens) // self.batchSize))
+        try:
+            page = int(self.request.get(self.pageName, 0))
+        except (TypeError, ValueError):
+            page = 0
+        page = min(max(page, 0), count - 1)
+        start = page * self.batchSize
+        current = tokens[start:start + self.batchSize]
+        self.hiddenTokens = tokens[:start] + tokens[start + self.batchSize:]
+        self.pages = []
+        if count > 1:
+            self.pages = [{'page': i, 'title': str(i + 1),
+                           'current': i == page} for i in range(count)]
+        values = [self.terms.getValue(token) for token in current]
+        for term in self.getTerms(values):
+            addTermItem(self, term)
+        self.hiddenTokens = [token for token in self.hiddenTokens
+                             if token not in self._itemTokens]
 
     def updateSearchForms(self):
         queriables = zope.schema.interfaces.ISourceQueriables(
@@ -403,9 +526,7 @@ class PrincipalSourceWidget(widget.HTMLInputWidget, SequenceWidget):
             queriables = ((self.name + '.query', self.source), )
         else:
             queriables = [
-                (self.name + '.' +
-                 str(i).encode('base64').strip().replace('=', '_'),
-                 s)
+                (self.name + '.' + toToken(str(i)), s)
                 for (i, s) in queriables.getQueriables()]
 
         self.searchForms = []